@@ -0,0 +1,188 @@
+from entur_data import EnturAPI
+from http_session import RequestStats, RETRY_STATUSES
+import aiohttp
+import asyncio
+import random
+import time
+
+class AsyncRateLimiter:
+    """Spaces out requests so that at most rate requests are started per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AsyncEnturAPI:
+    """
+    Asyncio client for the Entur journey planner, for polling many lines concurrently from one process.
+    Queries and response handling are shared with EnturAPI.
+
+    All requests share one connection pool, a global concurrency limit and a global rate limit.
+    Use the client as an async context manager:
+
+        async with AsyncEnturAPI() as client:
+            data = await client.get_realtime_journeys("RUT:Line:31")
+    """
+
+    def __init__(self, client_name="oslo-transit-optimizer", max_concurrency=20, rate_limit=20, timeout=30, retries=5, backoff_factor=0.5):
+        """
+        Args:
+            client_name (str): Name of your application for identification
+            max_concurrency (int): Maximum number of requests in flight
+            rate_limit (float): Maximum number of requests started per second
+            timeout (float): Total timeout of a request in seconds
+            retries (int): Maximum number of retries on connection errors, timeouts and the responses in RETRY_STATUSES
+            backoff_factor (float): Base of the exponential backoff between retries in seconds
+        """
+
+        self.endpoint = "https://api.entur.io/journey-planner/v3/graphql"
+        self.headers = {
+            "ET-Client-Name": client_name,
+            "Content-Type": "application/json",
+        }
+
+        self.max_concurrency = max_concurrency
+        self.rate_limit = rate_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        self.session = None
+        self.stats = RequestStats()
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._rate_limiter = AsyncRateLimiter(self.rate_limit)
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+        self.session = None
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                         API REQUESTS                               ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    async def execute_query(self, query: str, variables: dict = None) -> dict:
+        """
+        Execute a GraphQL query against the Entur API
+
+        Args:
+            query (str): GraphQL query string
+            variables (dict): Variables for the query (optional)
+
+        Returns:
+            dict: Response from the API, or None if the request failed
+        """
+
+        payload = {
+            "query": query,
+            "variables": variables or {}
+        }
+
+        start = time.perf_counter()
+
+        for attempt in range(self.retries + 1):
+            retry_after = None
+
+            try:
+                async with self._semaphore:
+                    await self._rate_limiter.wait()
+
+                    async with self.session.post(self.endpoint, json=payload) as response:
+                        if response.status in RETRY_STATUSES:
+                            retry_after = response.headers.get("Retry-After")
+                            error = f"{response.status} error from {self.endpoint}"
+
+                        elif response.status >= 400:
+                            #Other client and server errors will not change on a retry
+                            print(f"{response.status} error from {self.endpoint}: {response.reason}")
+                            self.stats.record(time.perf_counter() - start, False, attempt)
+                            return None
+
+                        else:
+                            try:
+                                result = await response.json(content_type=None)
+                            except ValueError as e:
+                                #E.g. an HTML error page from a proxy, which a retry is unlikely to fix
+                                print(f"Invalid JSON response from {self.endpoint}: {e}")
+                                self.stats.record(time.perf_counter() - start, False, attempt)
+                                return None
+
+                            if "errors" in result:
+                                print(f"GraphQL Error: {result['errors'][0]['message']}")
+                                self.stats.record(time.perf_counter() - start, False, attempt)
+                                return None
+
+                            self.stats.record(time.perf_counter() - start, True, attempt)
+                            return result
+
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+
+            if attempt < self.retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        print(error)
+        self.stats.record(time.perf_counter() - start, False, self.retries)
+        return None
+
+    def get_request_stats(self) -> dict:
+        """
+        Returns:
+            dict: Number of requests, retries and failures, and average/max latency in seconds
+        """
+        return self.stats.summary()
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                          API QUERIES                               ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    async def get_realtime_journeys(self, line_id: str) -> dict:
+        """
+        Get only journeys that have real-time data, see EnturAPI.get_realtime_journeys
+
+        Args:
+            line_id (str): The ID of the bus line (e.g., "RUT:Line:31")
+
+        Returns:
+            dict: Information about journeys with real-time data
+        """
+
+        response = await self.execute_query(EnturAPI.REALTIME_JOURNEYS_QUERY, {"lineId": line_id})
+
+        return EnturAPI.filter_realtime_journeys(response)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             HELPER                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def _backoff(self, attempt, retry_after = None):
+        """
+        Seconds to wait before the next attempt: Retry-After if the server sent it, else exponential backoff with full jitter,
+        a random wait between 0 and backoff_factor * 2^attempt seconds
+        """
+
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
@@ -137,6 +137,18 @@ class DataExplorer():
 
         return self._handle_output(result, output)
     
+    def get_memory_usage(self, output = 'dict'):
+        '''Bytes used by each feature, including the contents of object columns'''
+
+        usage = self.df.memory_usage(deep=True, index=False)
+
+        result = {
+            'total_bytes': int(usage.sum()),
+            'by_column': {col: int(usage[col]) for col in self.df.columns}
+        }
+
+        return self._handle_output(result, output)
+
     def get_duplicates(self, output = 'dict'):
         duplicated = self.df.duplicated().sum()
 
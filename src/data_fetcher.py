@@ -1,8 +1,16 @@
 from data_handler import DataHandler
 from entur_data import EnturAPI, EnturSQL
 from frostapi import FrostAPI
+from async_entur import AsyncEnturAPI
+from realtime_collection import JourneyTracker, JourneyBatch
+from weather_store import WeatherStore
+from spatial_index import StationIndex
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import random
 import time
 
 class DataFetcher:
@@ -18,7 +26,7 @@ class DataFetcher:
     
     def collect_trip_data(self, route_id: str, time_interval=600, num_samples=6):
         """
-        Collect multiple samples of trip data
+        Collect multiple samples of trip data. Each sample only adds the calls that departed since the previous sample
         
         Args:
             route_id (str): ID of the bus route
@@ -34,108 +42,183 @@ class DataFetcher:
             print("Failed to get line info")
             return None
                 
-        processed_journey_ids = set()
+        tracker = JourneyTracker()
 
         dfs = []
         
         for _ in range(num_samples):
             data = self.enturJP.get_realtime_journeys(route_id)
-            transport_mode = data['line']['transportMode']
-            if not data:
-                continue 
-
-            for journey in data['line']['serviceJourneys']:
-                journey_id = journey['id']
-                if journey_id in processed_journey_ids:
-                    continue
-
-                stops = journey['estimatedCalls']
-                if any([stop['actualDepartureTime'] is None for stop in stops]):
-                    continue
-                
-                processed_journey_ids.add(journey_id)
-                journey_df = self.get_journey_dataframe(journey,journey_id,transport_mode)               
-                dfs.append(journey_df)
+            if data:
+                dfs.append(self.get_new_calls(data, tracker))
         
             time.sleep(time_interval)
     
         return pd.concat(dfs) if dfs else None
-    
-    
-    def get_journey_dataframe(self, journey, journey_id, transport_mode):
+
+    def collect_trip_data_async(self, route_ids: list, time_interval=600, num_samples=6, max_concurrency=20, rate_limit=20):
+        """
+        Collect samples of trip data for many lines concurrently, see collect_trip_data
+
+        Each line is polled on its own schedule, starting at a random offset within the first interval
+        so the requests for all lines are spread out. All lines share one connection pool and the
+        concurrency and rate limits.
+
+        Args:
+            route_ids (list): IDs of the lines
+            time_interval (int): Time between each sample of a line in seconds
+            num_samples (int): Number of samples to collect per line
+            max_concurrency (int): Maximum number of requests in flight
+            rate_limit (float): Maximum number of requests per second
+
+        Returns:
+            dataframe: Concated dataframe of all samples of all lines
         """
-        Convert journey data to DataFrame
+
+        dfs = asyncio.run(self._collect_lines(route_ids, time_interval, num_samples, max_concurrency, rate_limit))
+
+        return pd.concat(dfs) if dfs else None
+
+    async def _collect_lines(self, route_ids, time_interval, num_samples, max_concurrency, rate_limit):
+        async with AsyncEnturAPI(max_concurrency=max_concurrency, rate_limit=rate_limit) as client:
+            results = await asyncio.gather(*[
+                self._poll_line(client, route_id, time_interval, num_samples) for route_id in route_ids
+            ])
+
+        return [df for line_dfs in results for df in line_dfs]
+
+    async def _poll_line(self, client, route_id, time_interval, num_samples):
+        tracker = JourneyTracker()
+        dfs = []
+
+        #Spreads the lines over the interval instead of polling all of them at once
+        await asyncio.sleep(random.uniform(0, time_interval))
+
+        for _ in range(num_samples):
+            #A failed poll of one line must not abort the polling of the other lines
+            try:
+                data = await client.get_realtime_journeys(route_id)
+                if data:
+                    dfs.append(self.get_new_calls(data, tracker))
+            except Exception as e:
+                print(f"Failed to poll {route_id}: {e}")
+
+            await asyncio.sleep(time_interval)
+
+        return dfs
+
+    def get_new_calls(self, data, tracker):
+        """
+        Convert the calls of a realtime sample that departed since the previous sample
         
         Args:
-            journey (json): Data for a specific journey from the Entur API
-            journey_id (str): ID of the journey
-            transport_mode (str): Mode of transport (e.g., 'bus')
+            data (dict): Response from get_realtime_journeys
+            tracker (JourneyTracker): State of the journeys of the line. Updated with the sample
             
         Returns:
-            dataframe: DataFrame containing journey data
+            dataframe: One row per newly departed call, empty if nothing departed
         """
-        
-        rows = []
-        
-        for stop in journey['estimatedCalls']:
-            stop['id'] = journey_id
-            stop['stop'] = stop['quay']['name']
-            rows.append(stop)
-
-        #Drop unnecessary columns
-        df = pd.DataFrame(rows).drop(['quay', 'realtime'], axis=1)
-        if transport_mode == 'bus':
-            df = df.drop(['aimedArrivalTime', 'expectedArrivalTime'], axis=1)
-
-        # Convert time columns to datetime
-        time_columns = [col for col in df.columns if 'Time' in col]
-        for col in time_columns:
-            df[col] = pd.to_datetime(df[col])
-
-        # Add collection timestamp
-        df['collectionTime'] = datetime.now()
-        
-        return df
+
+        batch = JourneyBatch(data['line']['transportMode'])
+        batch.extend(tracker.update(data))
+
+        return batch.to_frame(data['line']['id'], datetime.now())
+    
     
     #╔════════════════════════════════════════════════════════════════════╗
     #║                            ENTUR SQL                               ║
     #╚════════════════════════════════════════════════════════════════════╝
 
-    def get_data_SQL(self,line_id, start_date, end_date, target_times, window_minutes = 5):
+    def get_data_SQL(self,line_id, start_date, end_date, target_times, window_minutes = 5, dry_run = False):
         """
-        Gets dataframe from SQL
+        Gets dataframe from SQL, with one query for all target times
         
         Args:
-            line_id: 
+            line_id: ID of the line
             start_date: Format: YYYY-MM-DD
+            end_date: Format: YYYY-MM-DD
+            target_times (list): Times of day in HH:MM:SS format
+            window_minutes (int): Minutes before and after each target time
+            dry_run (bool): Only estimate the bytes the query would scan
 
+        Returns:
+            dataframe: Journeys starting within the window of any target time, tagged with it as targetTime.
+                       Number of bytes the query would scan if dry_run
         """
 
+        windows = self.get_time_windows(target_times, window_minutes)
 
-        dfs = []
+        query = self.enturSQL.get_data_by_lineid_and_timewindows(line_id, start_date, end_date, windows, execute=False)
+
+        if dry_run:
+            return self.enturSQL.estimate_bytes(query)
+
+        return self.enturSQL.query_to_dataframe(query)
+
+    def get_time_windows(self, target_times, window_minutes = 5):
+        """
+        Returns:
+            dict: (start_time, end_time) in HH:MM:SS format by target time. Windows may continue past midnight
+        """
+
+        windows = {}
         
         for target_time in target_times:
             target_time_dt = datetime.strptime(target_time,"%H:%M:%S")
             start_time = (target_time_dt - timedelta(minutes=window_minutes)).strftime("%H:%M:%S")
             end_time = (target_time_dt + timedelta(minutes=window_minutes)).strftime("%H:%M:%S")
 
-            df = self.enturSQL.get_data_by_lineid_and_timeframe(line_id, start_date,end_date, start_time, end_time)
-            
-            dfs.append(df)
+            windows[target_time] = (start_time, end_time)
 
-        return pd.concat(dfs) if dfs else None
+        return windows
     
+    def stream_data_SQL(self, line_id, start_date, end_date, target_times, window_minutes = 5, max_rows = 200_000, align_on = ('operatingDate',)):
+        """
+        Gets the same data as get_data_SQL with one query, yielding it in parts while it is downloaded
 
-    
+        Args:
+            line_id: ID of the line
+            start_date: Format: YYYY-MM-DD
+            end_date: Format: YYYY-MM-DD
+            target_times (list): Times of day in HH:MM:SS format
+            window_minutes (int): Minutes before and after each target time
+            max_rows (int): Approximate number of rows in each part
+            align_on (tuple): Columns whose groups are never split between parts. Default keeps each operating date
+                              whole, so every part covers complete dataset partitions
+
+        Yields:
+            dataframe: Consecutive parts of the data
+        """
+
+        windows = self.get_time_windows(target_times, window_minutes)
+        query = self.enturSQL.get_data_by_lineid_and_timewindows(line_id, start_date, end_date, windows, execute=False)
 
+        yield from self.enturSQL.iter_query_dataframes(query, max_rows=max_rows, align_on=align_on)
         
     #╔════════════════════════════════════════════════════════════════════╗
     #║                        FROST WEATHER DATA                          ║
     #╚════════════════════════════════════════════════════════════════════╝
     
 
-    def collect_weather_data(self,start_date, end_date, chunk_size = 15, elements_list = None, source_list = None, save_to_csv = True):
-        """Fetch current weather data"""
+    def collect_weather_data(self,start_date, end_date, chunk_size = 15, elements_list = None, source_list = None, save_to_csv = False, elements_per_request = 5, max_workers = 4, store = None):
+        """
+        Fetch weather data through the local weather store. Only the date ranges the store is missing are downloaded,
+        requesting up to elements_per_request elements per call and fetching the date chunks concurrently.
+        The request rate is limited by the Frost client.
+
+        Args:
+            start_date (str): Format: YYYY-MM-DD
+            end_date (str): Format: YYYY-MM-DD
+            chunk_size (int): Number of days per request. Frost returns at most FrostAPI.MAX_OBSERVATIONS per request
+            elements_list (list): Weather elements to fetch
+            source_list (list): Weather station IDs
+            save_to_csv (bool): Also save the data of each element as a csv-file
+            elements_per_request (int): Number of elements combined in one request
+            max_workers (int): Maximum number of requests in flight
+            store (WeatherStore): Store to use. Default is the store of DataHandler
+
+        Returns:
+            dataframe: One row per station and reference time, with a column for each element
+        """
 
         if elements_list is None:
             elements_list = [
@@ -149,74 +232,195 @@ class DataFetcher:
         if source_list is None:
             source_list = ['SN18700']
 
+        if store is None:
+            store = DataHandler().get_weather_store()
+
+        #Groups the missing elements of each station by chunk, so elements with the same gaps share requests
+        chunk_elements = {}
+        for source in source_list:
+            for element in elements_list:
+                for gap_start, gap_end in store.get_missing_ranges(source, element, start_date, end_date):
+                    for chunk in self._date_chunks(gap_start, gap_end, chunk_size):
+                        chunk_elements.setdefault((source, chunk), []).append(element)
+
+        jobs = [
+            (source, elements[i:i + elements_per_request], chunk)
+            for (source, chunk), elements in chunk_elements.items()
+            for i in range(0, len(elements), elements_per_request)
+        ]
+
+        def fetch_chunk(source, elements, chunk):
+            chunk_start, chunk_end = chunk
+            #The end of a Frost reference time range is exclusive, so the range ends the day after the chunk
+            parameters = {
+                'sources': source,
+                'elements': ','.join(elements),
+                'referencetime': f"{chunk_start}/{(pd.Timestamp(chunk_end) + timedelta(days=1)).strftime('%Y-%m-%d')}",
+            }
+            return self.frost.get_weather_data(parameters)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_chunk, *job): job for job in jobs}
+
+            for future in as_completed(futures):
+                source, elements, (chunk_start, chunk_end) = futures[future]
+                chunk_data = future.result()
 
-        sources = ','.join(source_list)
+                if chunk_data:
+                    store.add(self.frost_data_to_df(chunk_data), [source], elements, chunk_start, chunk_end)
+                else:
+                    print(f"Failed to fetch {', '.join(elements)} from {source} for chunk: {chunk_start}/{chunk_end}")
 
+        weather_df = store.load(source_list, elements_list, start_date, end_date, pivot=True)
+        elements = [element for element in elements_list if element in weather_df]
+        weather_df = weather_df[['sourceId', 'referenceTime'] + elements]
 
-        for element in elements_list:
-            chunk_dfs = []
+        if save_to_csv == True:
+            handler = DataHandler()
+            for element in elements:
+                element_df = weather_df[['sourceId', 'referenceTime', element]].dropna(subset=[element])
+                handler.save_raw_frost_data(element_df, f"{element}_{start_date}_{end_date}")
+                print(f"Saved {element} data to CSV")
 
-            start = datetime.strptime(start_date, '%Y-%m-%d')
-            end = datetime.strptime(end_date, '%Y-%m-%d')
-            
-            current_start = start
-            while current_start <= end:
-                current_end = min(current_start + timedelta(days=chunk_size-1), end)
+        return weather_df
 
-                time_range = f"{current_start.strftime('%Y-%m-%d')}/{current_end.strftime('%Y-%m-%d')}"
+    def _date_chunks(self, start_date, end_date, chunk_size):
+        """Splits a date range into (start_date, end_date) chunks of at most chunk_size days"""
 
-                parameters = {
-                    'sources': sources,
-                    'elements': element,
-                    'referencetime': time_range,
-                }
-                
-                chunk_data = self.frost.get_weather_data(parameters)
-                
-                if chunk_data:
-                    chunk_df = self.frost_data_to_df(chunk_data)
-                    chunk_dfs.append(chunk_df)
+        chunks = []
+        current_start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
 
-                else:
-                    print("Failed to fetch data for chunk:", time_range)
+        while current_start <= end:
+            current_end = min(current_start + timedelta(days=chunk_size-1), end)
+            chunks.append((current_start.strftime('%Y-%m-%d'), current_end.strftime('%Y-%m-%d')))
+            current_start = current_end + timedelta(days=1)
 
-                current_start = current_end + timedelta(days=1)
+        return chunks
 
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                        NEAREST STATIONS                            ║
+    #╚════════════════════════════════════════════════════════════════════╝
 
-            element_df = pd.concat(chunk_dfs) if chunk_dfs else None
+    def get_stop_coordinates(self, stop_ids):
+        """
+        Get the coordinates of stops, using batched Entur queries
 
-            if element_df is not None and save_to_csv == True:
-                DataHandler().save_raw_frost_data(element_df, f"{element}_{start_date}_{end_date}")
-                print(f"Saved {element} data to CSV")
-                
-        return pd.concat(chunk_dfs) if chunk_dfs else None
+        Args:
+            stop_ids (list): Quay IDs (e.g. the stopPointRef of the SIRI-ET data) or stop place IDs
 
+        Returns:
+            dataframe: stopPointRef, latitude and longitude of each stop that was found
+        """
+
+        stop_ids = list(dict.fromkeys(stop_ids))
+        quay_ids = [stop_id for stop_id in stop_ids if ':Quay:' in stop_id]
+        stop_place_ids = [stop_id for stop_id in stop_ids if ':Quay:' not in stop_id]
+
+        info = {**self.enturJP.get_quays_info(quay_ids), **self.enturJP.get_stops_info(stop_place_ids)}
+
+        return pd.DataFrame([
+            {'stopPointRef': stop_id, 'latitude': stop['latitude'], 'longitude': stop['longitude']}
+            for stop_id, stop in info.items()
+            if stop is not None
+        ], columns=['stopPointRef', 'latitude', 'longitude'])
 
-    def frost_data_to_df(self, data):
+    def get_station_index(self, stops, elements = None, margin = 0.2):
+        """
+        Builds a spatial index of the weather stations around stops
+
+        Args:
+            stops (dataframe): latitude and longitude of the stops, see get_stop_coordinates
+            elements (list): Only include stations that measure all these elements (optional)
+            margin (float): Degrees added around the bounding box of the stops when searching for stations
+
+        Returns:
+            StationIndex
+        """
+
+        south, north = stops['latitude'].min() - margin, stops['latitude'].max() + margin
+        west, east = stops['longitude'].min() - margin, stops['longitude'].max() + margin
+
+        parameters = {
+            'types': 'SensorSystem',
+            'geometry': f"POLYGON(({west:.4f} {south:.4f}, {east:.4f} {south:.4f}, {east:.4f} {north:.4f}, {west:.4f} {north:.4f}, {west:.4f} {south:.4f}))",
+        }
+        response = self.frost.get_weather_stations(parameters)
+
+        if response is None:
+            raise RuntimeError("Failed to fetch weather stations from Frost")
+
+        index = StationIndex.from_frost(response)
+
+        if elements:
+            station_ids = index.stations['sourceId'].tolist()
+            timeseries = self.frost.get_available_timeseries({'sources': ','.join(station_ids), 'elements': ','.join(elements)})
+
+            available = pd.DataFrame([
+                {'sourceId': series['sourceId'].split(':')[0], 'elementId': series['elementId']}
+                for series in (timeseries or {}).get('data', [])
+            ], columns=['sourceId', 'elementId'])
+
+            counts = available.drop_duplicates().groupby('sourceId')['elementId'].count()
+            measures_all = counts[counts == len(set(elements))].index
+
+            index = StationIndex(index.stations[index.stations['sourceId'].isin(measures_all)])
+
+        return index
+
+    def assign_weather_stations(self, stop_ids, elements = None, k = 1, max_distance_km = None):
+        """
+        Assigns each stop its nearest weather stations
+
+        Args:
+            stop_ids (list): Quay IDs or stop place IDs
+            elements (list): Only assign stations that measure all these elements (optional)
+            k (int): Number of stations per stop
+            max_distance_km (float): Ignore stations further away (optional)
+
+        Returns:
+            dataframe: stopPointRef, sourceId, distanceKm and rank of each stop and station
+        """
+
+        stops = self.get_stop_coordinates(stop_ids)
+        index = self.get_station_index(stops, elements)
+
+        return index.assign(stops, k, max_distance_km)
+
+    def frost_data_to_df(self, data, pivot = False):
         """
         Convert collected data to DataFrame
         
         Args:
-            data (list): List of dictionaries containing weather data
+            data (dict): Response from FrostAPI.get_weather_data
+            pivot (bool): Return one row per station and reference time with a column for each element, instead of one row per observation
             
         Returns:
-            dataframe: DataFrame containing weather data
+            dataframe: Columns sourceId, referenceTime, elementId, value, timeOffset and timeResolution, see FROST_SCHEMA
         """
-        
-        rows = []
-        
 
-        for item in data['data']:
-            source_id = item['sourceId']
-            reference_time = item['referenceTime']
-
-            for obs in item['observations']:
-                rows.append({
-                    'sourceId': source_id,
-                    'referenceTime': reference_time,
-                    obs['elementId']: obs['value'],
-                    'timeOffset': obs['timeOffset'],
-                    'timeResolution': obs['timeResolution']
-                })
-                
-        return pd.DataFrame.from_dict(rows)
\ No newline at end of file
+        items = data['data']
+
+        #Each item holds the observations of one station at one reference time
+        counts = np.fromiter((len(item['observations']) for item in items), dtype=np.int64, count=len(items))
+        observations = [obs for item in items for obs in item['observations']]
+
+        #Reference times are parsed once per item and repeated for its observations
+        reference_times = pd.to_datetime(pd.Series([item['referenceTime'] for item in items], dtype=object), format='ISO8601', utc=True)
+
+        df = pd.DataFrame({
+            'sourceId': np.repeat(np.array([item['sourceId'] for item in items], dtype=object), counts),
+            'referenceTime': reference_times.array.repeat(counts),
+            'elementId': [obs['elementId'] for obs in observations],
+            'value': np.fromiter((obs['value'] for obs in observations), dtype=np.float64, count=len(observations)),
+            'timeOffset': [obs.get('timeOffset') for obs in observations],
+            'timeResolution': [obs.get('timeResolution') for obs in observations],
+        })
+
+        return self.pivot_weather_data(df) if pivot else df
+
+    def pivot_weather_data(self, df):
+        """
+        Pivots observations from frost_data_to_df to one row per station and reference time with a column for each element, see WeatherStore.pivot
+        """
+        return WeatherStore.pivot(df)
@@ -1,14 +1,39 @@
 from numpy import std
+import numpy as np
 from data_exploration import DataExplorer
+from gtfs_store import GTFSStore
+from weather_store import WeatherStore
+from stop_pair_stats import StopPairStats, DelayCube
+from schemas import ENTUR_RAW_SCHEMA, ENTUR_PROCESSED_SCHEMA, FROST_SCHEMA, csv_dtypes
 import pandas as pd
 from datetime import datetime, timedelta
 from slugify import slugify
+from urllib.parse import unquote
+import pyarrow as pa
+import pyarrow.dataset as ds
+import threading
+import shutil
+import json
 import os
 
 class DataHandler:
-    def __init__(self, data_dir='data', dt_features = []):
-        """Initialize DataHandler with a data directory"""
+    #Partition layout of the columnar (parquet) datasets
+    ENTUR_PARTITIONING = pa.schema([('lineRef', pa.string()), ('operatingDate', pa.date32())])
+    FROST_PARTITIONING = pa.schema([('sourceId', pa.string())])
+
+    #Fixed integer types of compact_dtypes, so every chunk of a dataset gets the same schema
+    COMPACT_INTEGER_DTYPES = {'sequenceNr': 'Int16', 'nextSequenceNr': 'Int16', 'aimedStopTimeOfDay': 'Int32'}
+
+    def __init__(self, data_dir='data', dt_features = [], storage = 'csv'):
+        """
+        Initialize DataHandler with a data directory
+
+        Args:
+            storage (str): Default storage format for the save methods, either 'csv' or 'parquet'.
+                Parquet datasets are partitioned by lineRef/operatingDate (Entur) or sourceId (Frost) and keep dtypes.
+        """
         self.data_dir = data_dir
+        self.storage = storage
 
         current_dir = os.path.dirname(os.path.abspath(__file__))
         project_root = os.path.dirname(current_dir)
@@ -16,14 +41,21 @@ class DataHandler:
         self.processed_dir = os.path.join(project_root, 'data', 'processed')
         self.raw_dir = os.path.join(project_root, 'data', 'raw')
         self.gtfs_dir = os.path.join(self.raw_dir, 'Ruter-GTFS')
+        self.gtfs_store_dir = os.path.join(self.processed_dir, 'Ruter-GTFS')
+        self.gtfs_store = None
         self.entur_dir = os.path.join(self.raw_dir, )
 
         self.dt_features = dt_features
 
-        self.filenames = {
-            "air_temperature": "air_temperature_2024-01-01_2024-12-31.csv",
-            "relative_humidity": "relative_humidity_2024-01-01_2024-12-31.csv",
-        }
+        #Partition archive used by the incremental pipeline
+        self.entur_dataset = 'siri-et'
+        self.manifest_path = os.path.join(self.processed_dir, 'Entur-data', 'manifest.json')
+        self._manifest_lock = threading.Lock()
+        self.stop_pair_stats_dir = os.path.join(self.processed_dir, 'Stop-pair-stats')
+
+        #Downloaded weather observations, see WeatherStore
+        self.weather_store_dir = os.path.join(self.raw_dir, 'Frost-store')
+        self.weather_store = None
 
     #╔════════════════════════════════════════════════════════════════════╗
     #║                         FILE HANDLING                              ║
@@ -35,69 +67,426 @@ class DataHandler:
 
         return filename
 
-    def save_raw_entur_data(self, df, filename):
+    def save_raw_entur_data(self, df, filename, storage = None):
         """Save raw data with timestamp"""
+        if (storage or self.storage) == 'parquet':
+            filepath = os.path.join(self.raw_dir, 'Entur-data', filename)
+            return self.save_dataset(df, filepath, self.ENTUR_PARTITIONING)
+
         filepath = os.path.join(self.raw_dir, 'Entur-data', filename + '.csv')
         df.to_csv(filepath, index=False)
 
         return filepath
     
-    def save_processed_entur_data(self, df, filename):
+    def save_processed_entur_data(self, df, filename, storage = None):
         filepath = os.path.join(self.processed_dir, 'Entur-data', filename)
+
+        if (storage or self.storage) == 'parquet':
+            return self.save_dataset(df, filepath, self.ENTUR_PARTITIONING)
+
         df.to_csv(filepath,index=False)
 
         return filepath
     
-    def load_raw_entur_data(self, filename, datetime_convert=True):
+    def load_raw_entur_data(self, filename, datetime_convert=True, columns = None, line_ids = None, start_date = None, end_date = None):
+        """
+        Load raw Entur data from a csv-file or a parquet dataset directory.
+        With datetime_convert the columns are typed by ENTUR_RAW_SCHEMA.
+        Column projection applies to both formats, the line/date filters only to parquet datasets.
+        """
         filepath = os.path.join(self.raw_dir, 'Entur-data', filename)
-        loaded_df = pd.read_csv(filepath)
 
-        if datetime_convert:
-            return self.convert_date_to_datetime(loaded_df)
-        else:
-            return loaded_df
+        return self._load_file(filepath, ENTUR_RAW_SCHEMA if datetime_convert else None, columns, self.ENTUR_PARTITIONING, self._entur_filters(line_ids, start_date, end_date))
             
-    def load_processed_entur_data(self, filename, datetime_convert=True):
+    def load_processed_entur_data(self, filename, datetime_convert=True, columns = None, line_ids = None, start_date = None, end_date = None):
+        """
+        Load processed Entur data from a csv-file or a parquet dataset directory.
+        With datetime_convert the columns are typed by ENTUR_PROCESSED_SCHEMA.
+        Column projection applies to both formats, the line/date filters only to parquet datasets.
+        """
         filepath = os.path.join(self.processed_dir, 'Entur-data', filename)
-        loaded_df = pd.read_csv(filepath)
 
-        if datetime_convert:
-            return self.convert_date_to_datetime(loaded_df)
-        else:
-            return loaded_df
+        return self._load_file(filepath, ENTUR_PROCESSED_SCHEMA if datetime_convert else None, columns, self.ENTUR_PARTITIONING, self._entur_filters(line_ids, start_date, end_date))
     
 
-    def save_raw_frost_data(self, df, filename):
+    def save_raw_frost_data(self, df, filename, storage = None):
         """Save raw data with timestamp"""
+        if (storage or self.storage) == 'parquet':
+            filepath = os.path.join(self.raw_dir, 'Frost-data', filename)
+            return self.save_dataset(df, filepath, self.FROST_PARTITIONING)
+
         filepath = os.path.join(self.raw_dir, 'Frost-data', filename + '.csv')
         df.to_csv(filepath, index=False)
 
         return filepath
     
-    def save_processed_frost_data(self, df, filename):
+    def save_processed_frost_data(self, df, filename, storage = None):
         filepath = os.path.join(self.processed_dir, 'Frost-data', filename)
+
+        if (storage or self.storage) == 'parquet':
+            return self.save_dataset(df, filepath, self.FROST_PARTITIONING)
+
         df.to_csv(filepath,index=False)
 
         return filepath
     
-    def load_raw_frost_data(self, filename, datetime_convert=True):
+    def load_raw_frost_data(self, filename, datetime_convert=True, columns = None, source_ids = None, start_date = None, end_date = None):
         filepath = os.path.join(self.raw_dir, 'Frost-data', filename)
-        loaded_df = pd.read_csv(filepath)
 
-        if datetime_convert:
-            return self.convert_date_to_datetime(loaded_df)
-        else:
-            return loaded_df
+        return self._load_file(filepath, FROST_SCHEMA if datetime_convert else None, columns, self.FROST_PARTITIONING, self._frost_filters(source_ids, start_date, end_date))
             
-    def load_processed_frost_data(self, filename, datetime_convert=True):
+    def load_processed_frost_data(self, filename, datetime_convert=True, columns = None, source_ids = None, start_date = None, end_date = None):
         filepath = os.path.join(self.processed_dir, 'Frost-data', filename)
-        loaded_df = pd.read_csv(filepath)
 
-        if datetime_convert:
-            return self.convert_date_to_datetime(loaded_df)
+        return self._load_file(filepath, FROST_SCHEMA if datetime_convert else None, columns, self.FROST_PARTITIONING, self._frost_filters(source_ids, start_date, end_date))
+
+    def _load_file(self, filepath, schema, columns, partitioning, filters):
+        """Loads a parquet dataset directory or a csv-file, and applies the schema if given"""
+
+        if os.path.isdir(filepath):
+            loaded_df = self.load_dataset(filepath, partitioning, columns, filters)
+        elif schema is not None:
+            loaded_df = pd.read_csv(filepath, usecols=columns, dtype=csv_dtypes(schema, columns))
+        else:
+            loaded_df = pd.read_csv(filepath, usecols=columns)
+
+        if schema is not None:
+            return self.apply_schema(loaded_df, schema)
         else:
             return loaded_df
 
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                        PARQUET DATASETS                            ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def save_dataset(self, df, filepath, partitioning):
+        """
+        Writes a dataframe to a hive-partitioned parquet dataset.
+        Partitions present in the dataframe are replaced, all other partitions in the dataset are left untouched.
+
+        Args:
+            df (dataframe): Data to write. Must contain the partition columns
+            filepath (str): Root directory of the dataset
+            partitioning (pa.Schema): Partition columns and their types
+
+        Returns:
+            str: Path to the dataset
+        """
+
+        for field in partitioning:
+            if pa.types.is_date(field.type):
+                df = df.assign(**{field.name: pd.to_datetime(df[field.name]).dt.date})
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        for field in partitioning:
+            i = table.schema.get_field_index(field.name)
+            table = table.set_column(i, field, table.column(i).cast(field.type))
+
+        ds.write_dataset(
+            table,
+            filepath,
+            format='parquet',
+            partitioning=ds.partitioning(partitioning, flavor='hive'),
+            existing_data_behavior='delete_matching',
+            basename_template='part-{i}.parquet',
+        )
+
+        return filepath
+
+    def delete_line_partitions(self, filepath, line_id, dates):
+        """
+        Removes the lineRef/operatingDate partitions of a line from a dataset, e.g. dates that no longer have any data
+
+        Args:
+            filepath (str): Root directory of the dataset
+            line_id (str): The line of the partitions
+            dates (list): Operating dates in YYYY-MM-DD format
+        """
+
+        if not os.path.isdir(filepath):
+            return
+
+        #Partition values are URI encoded in the directory names (e.g. lineRef=RUT%3ALine%3A34)
+        for line_dir in os.listdir(filepath):
+            if unquote(line_dir) != f'lineRef={line_id}':
+                continue
+
+            for date in dates:
+                shutil.rmtree(os.path.join(filepath, line_dir, f'operatingDate={date}'), ignore_errors=True)
+
+    def load_dataset(self, filepath, partitioning, columns = None, filters = None):
+        """
+        Reads a hive-partitioned parquet dataset.
+        Filters on partition columns skip whole directories, other filters are pushed down to the parquet row groups.
+
+        Args:
+            filepath (str): Root directory of the dataset
+            partitioning (pa.Schema): Partition columns and their types
+            columns (list): Columns to read. Default is all columns
+            filters (list): List of (column, operator, value) tuples that are combined with AND
+
+        Returns:
+            dataframe: The selected rows and columns
+        """
+
+        dataset = ds.dataset(filepath, format='parquet', partitioning=ds.partitioning(partitioning, flavor='hive'))
+
+        expression = None
+        for col, op, value in filters or []:
+            field = ds.field(col)
+            value = self._to_scalar(value, dataset.schema.field(col).type)
+
+            if op == 'in':
+                condition = field.isin(value)
+            elif op == '>=':
+                condition = field >= value
+            elif op == '<':
+                condition = field < value
+            elif op == '<=':
+                condition = field <= value
+            else:
+                condition = field == value
+
+            expression = condition if expression is None else expression & condition
+
+        table = dataset.to_table(columns=columns, filter=expression)
+
+        return table.to_pandas(date_as_object=False)
+
+    def _entur_filters(self, line_ids = None, start_date = None, end_date = None):
+        filters = []
+
+        if line_ids:
+            filters.append(('lineRef', 'in', [line_ids] if isinstance(line_ids, str) else list(line_ids)))
+        if start_date:
+            filters.append(('operatingDate', '>=', start_date))
+        if end_date:
+            filters.append(('operatingDate', '<=', end_date))
+
+        return filters
+
+    def _frost_filters(self, source_ids = None, start_date = None, end_date = None, time_col = 'referenceTime'):
+        filters = []
+
+        if source_ids:
+            filters.append(('sourceId', 'in', [source_ids] if isinstance(source_ids, str) else list(source_ids)))
+        if start_date:
+            filters.append((time_col, '>=', start_date))
+        if end_date:
+            #End date is inclusive, so the whole last day is kept
+            filters.append((time_col, '<', pd.Timestamp(end_date) + timedelta(days=1)))
+
+        return filters
+
+    def _to_scalar(self, value, arrow_type):
+        """Converts a filter value to an arrow scalar of the column type"""
+
+        if isinstance(value, list):
+            return pa.array([self._to_scalar(v, arrow_type).as_py() for v in value], type=arrow_type)
+
+        if pa.types.is_date(arrow_type):
+            value = pd.Timestamp(value).date()
+        elif pa.types.is_timestamp(arrow_type):
+            value = pd.Timestamp(value)
+            if arrow_type.tz is not None and value.tzinfo is None:
+                value = value.tz_localize(arrow_type.tz)
+            elif arrow_type.tz is None and value.tzinfo is not None:
+                value = value.tz_convert('UTC').tz_localize(None)
+        elif (pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)) and isinstance(value, (datetime, pd.Timestamp)):
+            #Times stored as ISO 8601 strings in UTC (e.g. '2024-01-01T00:00:00.000Z') compare correctly as strings
+            value = pd.Timestamp(value)
+            if value.tzinfo is not None:
+                value = value.tz_convert('UTC').tz_localize(None)
+            value = value.strftime('%Y-%m-%dT%H:%M:%S')
+
+        return pa.scalar(value, type=arrow_type)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                     INCREMENTAL PROCESSING                         ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def load_manifest(self):
+        """
+        Loads the manifest of processed partitions
+
+        Returns:
+            dict: {line_id: {operatingDate: {'rows', 'fingerprint', 'selection', 'processed'}}}
+        """
+
+        if not os.path.exists(self.manifest_path):
+            return {}
+
+        with open(self.manifest_path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def save_manifest(self, manifest):
+        """Writes the manifest atomically, so an interrupted run never leaves a broken manifest"""
+
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, indent=2)
+
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_pending_dates(self, line_id, start_date, end_date, refresh_days = 2, selection = None):
+        """
+        Get the operating dates in a range that still need processing
+
+        Args:
+            line_id (str): The line to check
+            start_date (str): Format: YYYY-MM-DD
+            end_date (str): Format: YYYY-MM-DD
+            refresh_days (int): Dates this close to today are always pending, as their data may still change
+            selection (str): Journeys to extract, see selection_key. Dates processed with another selection are pending
+
+        Returns:
+            list: Pending dates in YYYY-MM-DD format
+        """
+
+        processed = self.load_manifest().get(line_id, {})
+        refresh_from = (datetime.now() - timedelta(days=refresh_days)).strftime('%Y-%m-%d')
+
+        dates = pd.date_range(start_date, end_date, freq='D').strftime('%Y-%m-%d')
+
+        return [
+            date for date in dates
+            if date not in processed or date >= refresh_from or processed[date].get('selection') != selection
+        ]
+
+    def selection_key(self, target_times, window_minutes = 5):
+        """
+        Identifies which journeys are extracted for each operating date, so a date is processed again when they change
+
+        Returns:
+            str: E.g. '08:00:00,16:00:00/5' for the target times 08:00 and 16:00 with 5 minute windows
+        """
+        return f"{','.join(sorted(set(target_times)))}/{window_minutes}"
+
+    def get_changed_partitions(self, line_id, df, selection = None):
+        """
+        Removes operating dates whose data is identical to what is already processed
+
+        Args:
+            line_id (str): The line the data belongs to
+            df (dataframe): Raw data
+            selection (str): Journeys the data was extracted with, see selection_key
+
+        Returns:
+            dataframe: Rows of the operating dates that are new or have changed
+        """
+
+        processed = self.load_manifest().get(line_id, {})
+        fingerprints = self._partition_fingerprints(df)
+
+        changed = [
+            date for date, fingerprint in fingerprints.items()
+            if (processed.get(date, {}).get('fingerprint'), processed.get(date, {}).get('selection')) != (fingerprint, selection)
+        ]
+        dates = pd.to_datetime(df['operatingDate']).dt.strftime('%Y-%m-%d')
+
+        return df[dates.isin(changed)]
+
+    def update_manifest(self, line_id, dates, df = None, selection = None):
+        """
+        Marks operating dates as processed
+
+        Args:
+            line_id (str): The line the data belongs to
+            dates (list): Operating dates that were processed, including dates without any data
+            df (dataframe): The raw data of the processed dates, used to fingerprint each date
+            selection (str): Journeys the data was extracted with, see selection_key
+        """
+
+        fingerprints = self._partition_fingerprints(df) if df is not None else {}
+        rows = pd.to_datetime(df['operatingDate']).dt.strftime('%Y-%m-%d').value_counts() if df is not None else {}
+        timestamp = datetime.now().isoformat(timespec='seconds')
+
+        #Parallel backfill shards update the manifest concurrently
+        with self._manifest_lock:
+            manifest = self.load_manifest()
+            line_manifest = manifest.setdefault(line_id, {})
+
+            for date in dates:
+                line_manifest[date] = {
+                    'rows': int(rows.get(date, 0)),
+                    'fingerprint': fingerprints.get(date),
+                    'selection': selection,
+                    'processed': timestamp,
+                }
+
+            self.save_manifest(manifest)
+
+    def clear_entur_partitions(self, line_id, dates):
+        """
+        Removes operating dates of a line from the raw and processed incremental datasets and the stop pair partials,
+        so dates without data under the current selection keep no rows from an earlier one
+        """
+
+        for filepath in [
+            os.path.join(self.raw_dir, 'Entur-data', self.entur_dataset),
+            os.path.join(self.processed_dir, 'Entur-data', self.entur_dataset),
+            self.stop_pair_stats_dir,
+        ]:
+            self.delete_line_partitions(filepath, line_id, dates)
+
+    def group_date_ranges(self, dates):
+        """
+        Groups dates into contiguous (start_date, end_date) ranges
+
+        Args:
+            dates (list): Dates in YYYY-MM-DD format
+
+        Returns:
+            list: List of (start_date, end_date) tuples
+        """
+
+        if not dates:
+            return []
+
+        days = pd.to_datetime(sorted(dates))
+        run_ids = (days.to_series().diff() != timedelta(days=1)).cumsum()
+
+        return [
+            (run.min().strftime('%Y-%m-%d'), run.max().strftime('%Y-%m-%d'))
+            for _, run in days.to_series().groupby(run_ids.to_numpy())
+        ]
+
+    def shard_date_ranges(self, dates, shard = 'month'):
+        """
+        Groups dates into contiguous (start_date, end_date) ranges that never cross a week or month boundary
+
+        Args:
+            dates (list): Dates in YYYY-MM-DD format
+            shard (str): 'week' or 'month'
+
+        Returns:
+            list: List of (start_date, end_date) tuples
+        """
+
+        periods = {'week': 'W', 'month': 'M'}
+        if shard not in periods:
+            raise ValueError(f"Unknown shard '{shard}', expected one of {list(periods)}")
+
+        shards = []
+        for run_start, run_end in self.group_date_ranges(dates):
+            days = pd.date_range(run_start, run_end, freq='D').to_series()
+
+            for _, days_in_period in days.groupby(days.dt.to_period(periods[shard]).to_numpy()):
+                shards.append((days_in_period.min().strftime('%Y-%m-%d'), days_in_period.max().strftime('%Y-%m-%d')))
+
+        return shards
+
+    def _partition_fingerprints(self, df):
+        """Order independent hash of the rows of each operating date"""
+
+        dates = pd.to_datetime(df['operatingDate']).dt.strftime('%Y-%m-%d')
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+
+        return {date: str(int(value)) for date, value in row_hashes.groupby(dates.to_numpy()).sum().items()}
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                         GTFS HANDLING                              ║
     #╚════════════════════════════════════════════════════════════════════╝
@@ -106,6 +495,26 @@ class DataHandler:
     GTFS data from Ruter retrived from https://developer.entur.org/stops-and-timetable-data at 14/02/2025 15:48  
     '''
 
+    def get_gtfs_store(self):
+        """
+        Opens the indexed GTFS store. The GTFS files are imported on first use and whenever they change.
+        """
+
+        if self.gtfs_store is None:
+            self.gtfs_store = GTFSStore(self.gtfs_dir, self.gtfs_store_dir).open()
+
+        return self.gtfs_store
+
+    def get_weather_store(self):
+        """
+        Opens the local store of weather observations
+        """
+
+        if self.weather_store is None:
+            self.weather_store = WeatherStore(self.weather_store_dir)
+
+        return self.weather_store
+
     def get_servicejourneys(self, route_id):
         """
         Get service journeys for a specific route
@@ -114,14 +523,10 @@ class DataHandler:
             route_id (str): The route ID to find journeys of
         
         Returns:
-            Routes which 
+            list: Trip IDs of the route
         """
-        
-        trips = pd.read_csv(os.path.join(self.gtfs_dir, 'trips.txt'))
-
-        routes = trips[trips['route_id'] == route_id]['trip_id']
 
-        return routes.to_list()
+        return self.get_gtfs_store().get_trips(route_id)
     
     def get_trips_by_timeframes(self,route_id: str, time_frames: list[tuple] = [('00:00:00', '23:59:59')]):
         """
@@ -134,19 +539,8 @@ class DataHandler:
         Returns:
             list: Unique trip IDs that operate within any of the given timeframes
         """
-        
-        stop_times = pd.read_csv(os.path.join(self.gtfs_dir, 'stop_times.txt'))
-
-        routes = self.get_servicejourneys(route_id)
-        route_stop_times = stop_times[(stop_times['trip_id'].isin(routes))]
-
-        unique_trip_ids = set()
 
-        for start_time, end_time in time_frames:
-            timeframe_trips = route_stop_times[(route_stop_times['arrival_time'] >= start_time) & (route_stop_times['arrival_time'] <= end_time)]['trip_id'].unique()
-            unique_trip_ids.update(timeframe_trips)
-
-        return list(unique_trip_ids)
+        return self.get_gtfs_store().get_trips_by_timeframes(route_id, time_frames)
     
     #╔════════════════════════════════════════════════════════════════════╗
     #║                         DATA CLEANING                              ║
@@ -181,6 +575,80 @@ class DataHandler:
 
         return df
 
+    def apply_schema(self, df, schema):
+        """
+        Converts the declared columns of a dataframe to the types of a schema, using fixed formats.
+        Columns that already have the declared type are left as they are, and undeclared columns are not touched.
+
+        Args:
+            df (dataframe): Data to convert
+            schema (dict): One of the schemas in the schemas module
+
+        Returns:
+            dataframe: The converted dataframe
+
+        Raises:
+            ValueError: If a declared column cannot be converted to its type
+        """
+
+        for col, spec in schema.items():
+            if col not in df.columns:
+                continue
+
+            try:
+                df[col] = self._cast_column(df[col], spec)
+            except (ValueError, TypeError) as e:
+                raise ValueError(f"Column '{col}' does not match the schema type '{spec['dtype']}': {e}") from e
+
+        return df
+
+    def _cast_column(self, series, spec):
+        dtype = spec['dtype']
+
+        if dtype == 'datetime':
+            if not pd.api.types.is_datetime64_any_dtype(series):
+                series = pd.to_datetime(series, format=spec['format'], utc=True)
+            elif series.dt.tz is None:
+                series = series.dt.tz_localize('UTC')
+
+            return series.dt.tz_convert(spec['tz'])
+
+        if dtype == 'date':
+            if pd.api.types.is_datetime64_any_dtype(series):
+                return series
+            if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+                return pd.to_datetime(series, format=spec['format'])
+
+            #Date types from BigQuery (dbdate) convert without parsing
+            return pd.to_datetime(series)
+
+        if dtype == 'timedelta':
+            if pd.api.types.is_timedelta64_dtype(series):
+                return series
+
+            return pd.to_timedelta(series)
+
+        if series.dtype == dtype or self._same_kind(series, dtype):
+            return series
+
+        #Before pandas 3, astype(str) turns missing values into the strings 'nan' and 'None'
+        if dtype == 'str':
+            return series.astype(dtype).where(series.notna())
+
+        return series.astype(dtype)
+
+    def _same_kind(self, series, dtype):
+        """Checks if a column already has the kind of type the schema declares, e.g. after compact_dtypes"""
+
+        if dtype.startswith('float'):
+            return pd.api.types.is_float_dtype(series)
+        if dtype.lower().startswith('int'):
+            return pd.api.types.is_integer_dtype(series)
+        if dtype == 'str':
+            return isinstance(series.dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(series)
+
+        return False
+
     def remove_missing_values(self,df, cutoff = 100):
         """
             Removes columns with a lot of missing values
@@ -197,22 +665,166 @@ class DataHandler:
 
         return df.drop(drop_cols, axis = 1)
         
+    def compact_dtypes(self, df, stop_categories = None, report = False):
+        """
+        Converts a processed dataframe to compact dtypes:
+            - Identifiers become categoricals, and the stop name columns share one stop dictionary
+            - Sequence numbers and times of day get the nullable integer types of COMPACT_INTEGER_DTYPES
+            - Floats are downcast to float32
+            - Durations are stored as Int32 seconds in a column with the suffix 'Seconds' (e.g. delay -> delaySeconds)
+
+        The types do not depend on the values, so chunks compacted separately share one schema.
+
+        Args:
+            df (dataframe): Processed data
+            stop_categories (list): Stop dictionary to use, e.g. to get the same codes in every chunk. Default is the stops in df.
+                Stops missing from the dictionary are added after the given stops, so the codes of the given stops are kept
+            report (bool): Prints the bytes used by each column before and after
+
+        Returns:
+            dataframe: The compacted dataframe
+        """
+
+        before = df.memory_usage(deep=True, index=False) if report else None
+        df = df.copy()
+
+        stop_cols = [col for col in ['stopPointName', 'nextStopPointName'] if col in df.columns]
+        stops = pd.unique(pd.concat([df[col] for col in stop_cols]).dropna()) if stop_cols else []
+        stop_categories = sorted(stops) if stop_categories is None else list(stop_categories)
+
+        known = set(stop_categories)
+        stop_dtype = pd.CategoricalDtype(stop_categories + sorted(stop for stop in stops if stop not in known))
+
+        for col in stop_cols:
+            df[col] = df[col].astype(stop_dtype)
+
+        for col in ['serviceJourneyId', 'lineRef', 'directionRef', 'stopPointRef', 'originName', 'destinationName']:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+
+        #Sequence numbers become floats when shifted, but are always whole numbers
+        for col, dtype in self.COMPACT_INTEGER_DTYPES.items():
+            if col in df.columns:
+                df[col] = df[col].astype(dtype)
+
+        renamed = {}
+        for col in df.columns:
+            series = df[col]
+
+            if pd.api.types.is_timedelta64_dtype(series):
+                renamed[col] = f'{col}Seconds'
+                df[renamed[col]] = series.dt.total_seconds().round().astype('Int32')
+                df = df.drop(columns=col)
+            elif pd.api.types.is_float_dtype(series):
+                df[col] = series.astype('float32')
+
+        if report:
+            print(self.compare_memory_usage(before.rename(index=renamed), df).to_string())
+
+        return df
+
+    def compare_memory_usage(self, before, after):
+        """
+        Bytes used by each column before and after a conversion
+
+        Args:
+            before: Dataframe or its memory_usage(deep=True) series
+            after: Dataframe or its memory_usage(deep=True) series
+
+        Returns:
+            dataframe: bytesBefore, bytesAfter and ratio per column, with a total row
+        """
+
+        if isinstance(before, pd.DataFrame):
+            before = pd.Series(DataExplorer(before).get_memory_usage()['by_column'])
+        if isinstance(after, pd.DataFrame):
+            after = pd.Series(DataExplorer(after).get_memory_usage()['by_column'])
+
+        usage = pd.DataFrame({'bytesBefore': before, 'bytesAfter': after})
+        usage.loc['total'] = usage.sum()
+        usage['ratio'] = usage['bytesAfter'] / usage['bytesBefore']
+
+        return usage
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                         DATA FILTERING                             ║
     #╚════════════════════════════════════════════════════════════════════╝     
 
-    def filter_by_time(self, df, start_time, end_time, time_col = 'aimedStopTime'):
+    def filter_by_time(self, df, start_time, end_time, time_col = 'aimedStopTime', time_index = None):
         """
-        Filters the dataframe by a specific time range
+        Filters the dataframe by a specific time range. The range wraps past midnight when start_time is later than end_time.
+
+        Uses the seconds of day column from append_time_of_day when present, and binary search when a time_index
+        from build_time_index is given.
         """
-        
-        return df[(df[time_col].dt.time >= pd.to_datetime(start_time).time()) & (df[time_col].dt.time <= pd.to_datetime(end_time).time())]
+
+        start = self._seconds_of_day(pd.to_datetime(start_time))
+        end = self._seconds_of_day(pd.to_datetime(end_time))
+
+        if time_index is not None:
+            seconds = time_index.to_numpy()
+
+            if start <= end:
+                positions = time_index.index[seconds.searchsorted(start, 'left'):seconds.searchsorted(end, 'right')]
+            else:
+                #Missing times are stored as -1 and sorted first
+                positions = np.concatenate([
+                    time_index.index[seconds.searchsorted(start, 'left'):],
+                    time_index.index[seconds.searchsorted(0, 'left'):seconds.searchsorted(end, 'right')],
+                ])
+
+            return df.iloc[np.sort(positions)]
+
+        if f'{time_col}OfDay' in df.columns:
+            seconds = df[f'{time_col}OfDay']
+        else:
+            seconds = self._seconds_of_day(df[time_col]).fillna(-1)
+
+        if start <= end:
+            return df[(seconds >= start) & (seconds <= end)]
+        else:
+            return df[(seconds >= start) | ((seconds >= 0) & (seconds <= end))]
+
+    def build_time_index(self, df, time_col = 'aimedStopTime'):
+        """
+        Sorted index over the time of day of a column, for repeated filter_by_time calls on the same dataframe
+
+        Returns:
+            series: Seconds of day in ascending order, indexed by the row position in df
+        """
+
+        if f'{time_col}OfDay' in df.columns:
+            seconds = df[f'{time_col}OfDay'].to_numpy()
+        else:
+            seconds = self._seconds_of_day(df[time_col]).fillna(-1).to_numpy(dtype=np.int32)
+
+        order = np.argsort(seconds, kind='stable')
+
+        return pd.Series(seconds[order], index=order)
+
+    def _seconds_of_day(self, times):
+        """Seconds since midnight of a timestamp or a datetime series"""
+
+        if isinstance(times, pd.Series):
+            return times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second
+
+        return times.hour * 3600 + times.minute * 60 + times.second
 
 
     #╔════════════════════════════════════════════════════════════════════╗
     #║                      FEATURE ENGINEERING                           ║
     #╚════════════════════════════════════════════════════════════════════╝ 
 
+    def append_time_of_day(self, df, time_col = 'aimedStopTime'):
+        """
+        Adds the time of day of a datetime column as integer seconds since midnight, -1 where the time is missing.
+        filter_by_time and build_time_index use the column instead of converting the timestamps on every call.
+        """
+
+        df[f'{time_col}OfDay'] = self._seconds_of_day(df[time_col]).fillna(-1).astype(np.int32)
+
+        return df
+
     def merge_duplicated_stop_times(self,df):
         """
         Merge arrival and departure features, as these have the same values except for endpoints for most bus routes. 
@@ -295,6 +907,51 @@ class DataHandler:
         df['delayChange'] = df.groupby('serviceJourneyId')['delayMinutes'].diff()
 
         return df
+
+    def engineer_journey_features(self, df):
+        """
+        Computes the next stop, delay, delay change and time to next stop features in a single pass.
+
+        The frame is sorted once by operatingDate, serviceJourneyId and sequenceNr, and the journey boundaries are found once.
+        Every feature is then a plain shift over the sorted columns, masked at the boundaries, instead of a groupby per feature.
+        A journey is a serviceJourneyId on a single operatingDate, so no values are carried over from one day to the next.
+
+        Returns:
+            Sorted dataframe with the same features as append_next_stop, calculate_delay,
+            calculate_delay_change and calculate_time_between_stops
+        """
+
+        df = df.sort_values(['operatingDate', 'serviceJourneyId', 'sequenceNr'], kind='stable')
+
+        date_codes = pd.factorize(df['operatingDate'])[0]
+        journey_codes = pd.factorize(df['serviceJourneyId'])[0]
+
+        #has_next[i] is True when row i+1 is the next stop of the same journey
+        has_next = np.zeros(len(df), dtype=bool)
+        has_next[:-1] = (date_codes[1:] == date_codes[:-1]) & (journey_codes[1:] == journey_codes[:-1])
+        has_previous = np.zeros(len(df), dtype=bool)
+        has_previous[1:] = has_next[:-1]
+
+        def next_value(col):
+            return df[col].shift(-1).where(has_next)
+
+        df['nextSequenceNr'] = next_value('sequenceNr')
+        df['nextStopPointName'] = next_value('stopPointName').where(df['nextSequenceNr'] == df['sequenceNr'] + 1)
+
+        df = self.calculate_delay(df)
+
+        if 'stopTime' in df.columns:
+            df['delayChange'] = (df['delayMinutes'] - df['delayMinutes'].shift(1)).where(has_previous)
+            df['timeToNextStop'] = next_value('stopTime') - df['stopTime']
+            df['aimedTimeToNextStop'] = next_value('aimedStopTime') - df['aimedStopTime']
+        else:
+            df['timeToNextStop'] = next_value('arrivalTime') - df['departureTime']
+            df['aimedTimeToNextStop'] = next_value('aimedArrivalTime') - df['aimedDepartureTime']
+
+        df['timeToNextStopMinutes'] = df['timeToNextStop'].dt.total_seconds() / 60
+        df['aimedTimeToNextStopMinutes'] = df['aimedTimeToNextStop'].dt.total_seconds() / 60
+
+        return df
     
     #╔════════════════════════════════════════════════════════════════════╗
     #║                          DATA ANALYSIS                             ║
@@ -321,25 +978,68 @@ class DataHandler:
         ).reset_index()
 
         return stop_pairs
+
+    def save_stop_pair_partials(self, df):
+        """
+        Stores mergeable stop pair statistics for each line and operating date in the data.
+        Partials of the same line and date are replaced, so reprocessing a day does not count it twice.
+
+        Returns:
+            str: Path to the partials dataset
+        """
+
+        partials = StopPairStats.from_frame(df, ['lineRef', 'operatingDate'] + StopPairStats.PAIR_KEYS)
+
+        return self.save_dataset(partials.moments, self.stop_pair_stats_dir, self.ENTUR_PARTITIONING)
+
+    def load_stop_pair_stats(self, line_ids = None, start_date = None, end_date = None):
+        """
+        Combines the stored partials into stop pair statistics without touching the processed data
+
+        Returns:
+            dataframe: Same layout as get_stop_pair_stats, or None if no partials are stored
+        """
+
+        if not os.path.isdir(self.stop_pair_stats_dir):
+            return None
+
+        moments = self.load_dataset(self.stop_pair_stats_dir, self.ENTUR_PARTITIONING, filters=self._entur_filters(line_ids, start_date, end_date))
+
+        return StopPairStats(moments).collapse(StopPairStats.PAIR_KEYS).to_frame()
     
-    def get_average_delay_by_time(self,df, target_time, limit = 10, hours = 1):
+    def build_delay_cube(self, df, bucket_minutes = 15, time_col = 'aimedStopTime'):
+        """
+        Precomputes stop pair statistics per time of day bucket, weekday and month.
+        Pass the cube to get_average_delay_by_time to answer time window queries without scanning the data.
+        """
+
+        return DelayCube.from_frame(df, bucket_minutes, time_col)
+
+    def get_average_delay_by_time(self,df, target_time, limit = 10, hours = 1, cube = None):
         """
         Get average delay between stops for a specific time window
+
+        Args:
+            df (dataframe): Processed data. Not used when a cube is given
+            cube (DelayCube): Precomputed cube from build_delay_cube. The window is then widened to whole buckets
         """
 
         target_time_dt = datetime.strptime(target_time, '%H:%M:%S')
         start = target_time_dt - timedelta(hours=hours)
         end = target_time_dt + timedelta(hours=hours)
 
-        time_df = self.filter_by_time(df, start, end)
-        stop_pairs = self.get_stop_pair_stats(time_df)
+        if cube is not None:
+            stop_pairs = cube.query(start, end).to_frame()
+        else:
+            time_df = self.filter_by_time(df, start, end)
+            stop_pairs = self.get_stop_pair_stats(time_df)
 
         stop_pairs = stop_pairs[stop_pairs['count'] > limit].sort_values('delayChangeAvg')
 
         return stop_pairs[['stopPointName', 'nextStopPointName', 'delayChangeAvg','delayChangeMax']]
 
 
-    def get_weather_delay_correlation(self, transit_df, weather_df = None, weather = "surface_snow_thickness"):
+    def get_weather_delay_correlation(self, transit_df, weather_df = None, weather = "surface_snow_thickness", source_id = "SN18700", time_col = "stopTime"):
 
         '''
         Calculates the correlation between delay and weather data
@@ -349,16 +1049,173 @@ class DataHandler:
             'sum(precipitation_amount PT10M)', 
             'wind_speed', 
             'relative_humidity'
+
+        Without weather_df, the weather of the station source_id is loaded from the weather store for the dates of transit_df.
+        Download missing dates first with DataFetcher.collect_weather_data.
         '''
 
         if weather_df is None:
-            weather_df = self.load_raw_frost_data(f"{weather}_2024-01-01_2024-12-31.csv")
+            start_date = transit_df[time_col].min().strftime('%Y-%m-%d')
+            end_date = transit_df[time_col].max().strftime('%Y-%m-%d')
+
+            store = self.get_weather_store()
+            if not store.is_covered([source_id], [weather], start_date, end_date):
+                print(f"Weather store is missing {weather} from {source_id} for parts of {start_date} to {end_date}")
+
+            weather_df = store.load([source_id], [weather], start_date, end_date, pivot=True)
 
         joined_df = self.join_transit_and_weather_data(transit_df, weather_df)
 
         correlation = joined_df[['delayMinutes', weather]].corr()
 
         return correlation
+
+    def get_weather_delay_correlations(self, transit_df, weather_df = None, elements = None, lags = ('0h',), by = ('stopPointName', 'nextStopPointName'),
+                                       delay_col = 'delayMinutes', time_col = 'stopTime', source_id = 'SN18700', stations = None, tolerance = '1h', min_samples = 10):
+        """
+        Correlates delay with several weather elements at several time lags, for every group (e.g. stop pair) at once.
+
+        The weather is aligned onto the transit timestamps once for all elements and lags, and the correlations of
+        all groups, elements and lags are computed from grouped sums in a single pass.
+
+        Args:
+            transit_df (dataframe): Processed data
+            weather_df (dataframe): sourceId, referenceTime and a column for each element. Default is loaded from the weather store
+            elements (list): Weather elements. Default is every element column of weather_df, or every stored element
+            lags (list): How long before the stop time the weather is taken, e.g. ['0h', '1h', '3h']
+            by (tuple): Columns to correlate within, None for the whole network
+            delay_col (str): Delay column to correlate with
+            time_col (str): Time of each stop
+            source_id (str): Weather station, used when no stations are given
+            stations (dataframe): stopPointRef and sourceId of each stop, see DataFetcher.assign_weather_stations
+            tolerance (str): Maximum time between a stop and the weather observation used for it
+            min_samples (int): Minimum number of stops with both delay and weather for a correlation
+
+        Returns:
+            dataframe: by columns, element, lag, count and correlation, one row per group, element and lag
+        """
+
+        by = list(by) if by else []
+        lags = pd.to_timedelta(list(lags))
+
+        transit_df = transit_df.dropna(subset=[time_col, delay_col] + by)
+
+        if stations is not None and 'rank' in stations:
+            stations = stations[stations['rank'] == 1]
+
+        station_ids = stations['sourceId'].unique().tolist() if stations is not None else [source_id]
+
+        if weather_df is None:
+            store = self.get_weather_store()
+
+            if elements is None:
+                coverage = store.load_coverage()
+                elements = sorted({element for station in station_ids for element in coverage.get(station, {})})
+
+            start_date = (transit_df[time_col].min() - lags.max()).strftime('%Y-%m-%d')
+            end_date = transit_df[time_col].max().strftime('%Y-%m-%d')
+            weather_df = store.load(station_ids, elements, start_date, end_date, pivot=True)
+
+        if elements is None:
+            elements = [col for col in weather_df.columns if col not in ('sourceId', 'referenceTime')]
+
+        #Frost sourceIds include the sensor (e.g. 'SN18700:0'), the stations do not
+        weather_stations = weather_df['sourceId'].astype(str).str.split(':').str[0]
+        if stations is not None:
+            transit_stations = transit_df['stopPointRef'].map(stations.set_index('stopPointRef')['sourceId'])
+        else:
+            transit_stations = pd.Series(source_id, index=transit_df.index)
+
+        weather = self._align_weather(
+            transit_df[time_col], transit_stations, weather_df['referenceTime'], weather_stations,
+            weather_df[elements].to_numpy(dtype=np.float64), lags, pd.Timedelta(tolerance),
+        )
+
+        #Sums of every group, lag and element, centered by the overall means for numerical stability
+        n_lags, n_elements = len(lags), len(elements)
+        x = weather.reshape(len(transit_df), n_lags * n_elements)
+        y = transit_df[delay_col].to_numpy(dtype=np.float64)[:, None]
+
+        valid = ~np.isnan(x)
+        x_mean = np.where(valid, x, 0.0).sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+        x = np.where(valid, x - x_mean, 0.0)
+        y = np.where(valid, y - y.mean(), 0.0)
+
+        if by:
+            codes, groups = pd.MultiIndex.from_frame(transit_df[by]).factorize()
+        else:
+            codes, groups = np.zeros(len(transit_df), dtype=np.int64), None
+
+        #One grouped sum of every term of the correlations
+        columns = n_lags * n_elements
+        sums = pd.DataFrame(np.hstack([valid, x, y, x * x, y * y, x * y])).groupby(codes).sum().to_numpy()
+        n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = (sums[:, i * columns:(i + 1) * columns] for i in range(6))
+
+        covariance = n * sum_xy - sum_x * sum_y
+        variance = (n * sum_xx - sum_x ** 2) * (n * sum_yy - sum_y ** 2)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = np.where((n >= min_samples) & (variance > 0), covariance / np.sqrt(variance), np.nan)
+
+        #Columns are ordered by lag, then element
+        n_groups = n.shape[0]
+        result = pd.DataFrame({
+            'element': np.tile(np.tile(np.asarray(elements, dtype=object), n_lags), n_groups),
+            'lag': np.tile(np.repeat(lags.to_numpy(), n_elements), n_groups),
+            'count': n.ravel().astype(np.int64),
+            'correlation': correlation.ravel(),
+        })
+
+        if by:
+            group_keys = groups.to_frame(index=False)
+            group_keys.columns = by
+            result = pd.concat([group_keys.loc[group_keys.index.repeat(columns)].reset_index(drop=True), result], axis=1)
+
+        return result[result['count'] >= min_samples].reset_index(drop=True)
+
+    def _align_weather(self, times, stations, weather_times, weather_stations, values, lags, tolerance):
+        """
+        Finds the observation of each element nearest to each time minus each lag, from the station of each row.
+        Missing observations are skipped, like dropping them before a merge_asof.
+
+        Returns:
+            array: Weather values of shape (rows, lags, elements), NaN where no observation is within tolerance
+        """
+
+        #Station and time are combined into one sortable key, stations are far enough apart to never match across
+        codes = pd.Index(pd.unique(weather_stations))
+        station_span = 10**10
+
+        weather_key = codes.get_indexer(weather_stations).astype(np.int64) * station_span + self._epoch_seconds(weather_times)
+        order = np.argsort(weather_key, kind='stable')
+        weather_key, values = weather_key[order], values[order]
+
+        row_codes = codes.get_indexer(stations)
+        keys = (row_codes.astype(np.int64) * station_span + self._epoch_seconds(times))[:, None] - (lags.total_seconds().to_numpy().astype(np.int64))[None, :]
+
+        aligned = np.full((len(keys), len(lags), values.shape[1]), np.nan)
+
+        for element in range(values.shape[1]):
+            observed = ~np.isnan(values[:, element])
+            element_key, element_values = weather_key[observed], values[observed, element]
+
+            if len(element_key) == 0:
+                continue
+
+            right = np.minimum(np.searchsorted(element_key, keys), len(element_key) - 1)
+            left = np.maximum(right - 1, 0)
+
+            nearest = np.where(np.abs(element_key[right] - keys) < np.abs(keys - element_key[left]), right, left)
+            within = (np.abs(element_key[nearest] - keys) <= tolerance.total_seconds()) & (row_codes >= 0)[:, None]
+
+            aligned[..., element] = np.where(within, element_values[nearest], np.nan)
+
+        return aligned
+
+    def _epoch_seconds(self, times):
+        times = pd.to_datetime(pd.Series(times), utc=True)
+
+        return ((times - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)).to_numpy(dtype=np.int64)
         
     #╔════════════════════════════════════════════════════════════════════╗
     #║                              PLOTS                                 ║
@@ -371,10 +1228,15 @@ class DataHandler:
     #║                            JOINING                                 ║
     #╚════════════════════════════════════════════════════════════════════╝ 
     
-    def join_transit_and_weather_data(self, transit_df, weather_df, time_col='stopTime', weather_time_col='referenceTime'):
+    def join_transit_and_weather_data(self, transit_df, weather_df, time_col='stopTime', weather_time_col='referenceTime', stations=None):
         """
         Join transit and weather data on the date column
-        
+
+        With stations, each stop is joined with the weather of its own station instead of a single series.
+
+        Args:
+            stations (dataframe): stopPointRef and sourceId of each stop, see DataFetcher.assign_weather_stations.
+                                  Only the nearest station (rank 1) is used
         """
         
         transit_copy = transit_df.copy()
@@ -382,12 +1244,33 @@ class DataHandler:
 
         transit_copy = transit_copy.dropna(subset=[time_col])
         weather_copy = weather_copy.dropna(subset=[weather_time_col])
-               
+
+        if stations is None:
+            joined_df = pd.merge_asof(
+                transit_copy.sort_values(time_col),
+                weather_copy.sort_values(weather_time_col),
+                left_on=time_col,
+                right_on=weather_time_col,
+                direction='nearest'
+            )
+
+            return joined_df
+
+        if 'rank' in stations:
+            stations = stations[stations['rank'] == 1]
+
+        #Frost sourceIds include the sensor (e.g. 'SN18700:0'), the stations do not
+        weather_copy['sourceId'] = weather_copy['sourceId'].astype(str).str.split(':').str[0].astype(str)
+        transit_copy['sourceId'] = transit_copy['stopPointRef'].map(stations.set_index('stopPointRef')['sourceId'])
+        transit_copy = transit_copy.dropna(subset=['sourceId'])
+        transit_copy['sourceId'] = transit_copy['sourceId'].astype(str)
+
         joined_df = pd.merge_asof(
             transit_copy.sort_values(time_col),
             weather_copy.sort_values(weather_time_col),
             left_on=time_col,
             right_on=weather_time_col,
+            by='sourceId',
             direction='nearest'
         )
 
@@ -1,16 +1,104 @@
-import requests
+from http_session import create_session, RequestStats, count_retries
+from response_cache import ResponseCache, QueryResultCache, CACHE_DIR
 from datetime import datetime, timedelta
 from google.cloud import bigquery
 import pandas_gbq as pdgbq
+import pandas as pd
+import numpy as np
 import functools
+import time
+import os
 
 class EnturAPI:
-    def __init__(self, client_name="oslo-transit-optimizer"):
+    #Selection sets shared by the single and the batched queries
+    STOP_INFO_FIELDS = """
+        id
+        latitude
+        longitude
+        name
+        description
+        quays {
+            id
+            name
+            publicCode
+            lines {
+                id
+                name
+                transportMode
+            }
+        }
+    """
+
+    QUAY_INFO_FIELDS = """
+        id
+        name
+        latitude
+        longitude
+        stopPlace {
+            id
+        }
+    """
+
+    LINE_INFO_FIELDS = """
+        id
+        name
+        transportMode
+        quays {
+            id
+            name
+        }
+    """
+
+    REALTIME_JOURNEYS_FIELDS = """
+        id
+        name
+        transportMode
+        serviceJourneys {
+            id
+            estimatedCalls {
+                actualArrivalTime
+                actualDepartureTime
+                aimedArrivalTime
+                aimedDepartureTime
+                expectedArrivalTime
+                expectedDepartureTime
+                realtime
+                stopPositionInPattern
+                quay {
+                    id
+                    name
+                }
+            }
+        }
+    """
+
+    #Seconds that metadata responses are cached, the timetable data changes at most daily
+    CACHE_TTLS = {
+        "stopPlace": 24 * 3600,
+        "quay": 24 * 3600,
+        "line": 24 * 3600,
+    }
+
+    REALTIME_JOURNEYS_QUERY = f"""
+    query ($lineId: ID!) {{
+        line(id: $lineId) {{
+            {REALTIME_JOURNEYS_FIELDS}
+        }}
+    }}
+    """
+
+    def __init__(self, client_name="oslo-transit-optimizer", pool_size=10, timeout=(5, 30), retries=5, backoff_factor=0.5, cache_dir=os.path.join(CACHE_DIR, "entur"), cache_entries=256):
         """
         Initialize the Entur API client
         
         Args:
             client_name (str): Name of your application for identification
+            pool_size (int): Number of keep-alive connections to the API
+            timeout (tuple): Connect and read timeout in seconds
+            retries (int): Maximum number of retries on connection errors and 429/5xx responses
+            backoff_factor (float): Base of the exponential backoff between retries in seconds
+            cache_dir (str): Directory where metadata responses are cached between runs, default data/cache/entur in the project root. None caches in memory only
+            cache_entries (int): Maximum number of responses cached in memory
         """
 
         self.endpoint = "https://api.entur.io/journey-planner/v3/graphql"
@@ -20,17 +108,23 @@ class EnturAPI:
             "Content-Type": "application/json",
         }
 
+        self.timeout = timeout
+        self.session = create_session(pool_size, retries, backoff_factor, headers=self.headers)
+        self.stats = RequestStats()
+        self.cache = ResponseCache(cache_dir, cache_entries)
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                         API REQUESTS                               ║
     #╚════════════════════════════════════════════════════════════════════╝    
     
-    def execute_query(self, query: str, variables: dict = None) -> dict:
+    def execute_query(self, query: str, variables: dict = None, partial: bool = False) -> dict:
         """
         Execute a GraphQL query against the Entur API
         
         Args:
             query (str): GraphQL query string
             variables (dict): Variables for the query (optional)
+            partial (bool): Return the data of a response with errors, e.g. for batched queries where only some ids failed
             
         Returns:
             dict: Response from the API
@@ -41,8 +135,11 @@ class EnturAPI:
             "variables": variables or {}
         }
         
+        start = time.perf_counter()
+        response = None
+
         try:
-            response = requests.post(self.endpoint, json=payload, headers=self.headers)
+            response = self.session.post(self.endpoint, json=payload, timeout=self.timeout)
             response.raise_for_status()
 
             try: 
@@ -50,18 +147,62 @@ class EnturAPI:
 
                 if "errors" in result:
                     print(f"GraphQL Error: {result['errors'][0]['message']}")
-                    return None
+
+                    if not (partial and result.get("data")):
+                        self.stats.record(time.perf_counter() - start, False, count_retries(response))
+                        return None
                     
+                self.stats.record(time.perf_counter() - start, True, count_retries(response))
                 return result
             
             except ValueError as e:
                 print(f"JSON Parse Error: {e}")
+                self.stats.record(time.perf_counter() - start, False, count_retries(response))
                 return None
             
 
         except Exception as e:
             print(str(e))
+            self.stats.record(time.perf_counter() - start, False, count_retries(response))
             return None
+
+    def get_request_stats(self) -> dict:
+        """
+        Returns:
+            dict: Number of requests, retries and failures, and average/max latency in seconds
+        """
+        return self.stats.summary()
+
+    def execute_cached_query(self, query: str, variables: dict = None, ttl: float = 3600) -> dict:
+        """
+        Execute a GraphQL query, reusing a cached response younger than ttl seconds.
+        Failed requests are not cached.
+
+        Args:
+            query (str): GraphQL query string
+            variables (dict): Variables for the query (optional)
+            ttl (float): Seconds the response is cached
+
+        Returns:
+            dict: Response from the API
+        """
+
+        response = self.cache.get(query, variables)
+
+        if response is None:
+            response = self.execute_query(query, variables)
+
+            if response is not None:
+                self.cache.set(query, variables, response, ttl)
+
+        return response
+
+    def get_cache_stats(self) -> dict:
+        """
+        Returns:
+            dict: Memory hits, disk hits, misses and hit rate of the metadata cache
+        """
+        return self.cache.stats()
                 
 
     def test_connection(self) -> bool:
@@ -99,30 +240,16 @@ class EnturAPI:
             dict: Information about the stop
         """
 
-        query = """
-        query GetStpInfo($id: String!) {
-            stopPlace(id: $id) {
-                id
-                latitude
-                longitude
-                name
-                description
-                quays {
-                    id
-                    name
-                    publicCode
-                    lines {
-                        id
-                        name
-                        transportMode
-                    }
-                }
-            }
-        }
+        query = f"""
+        query GetStpInfo($id: String!) {{
+            stopPlace(id: $id) {{
+                {self.STOP_INFO_FIELDS}
+            }}
+        }}
         """
         variables = {"id": stop_id}
         
-        response = self.execute_query(query, variables)
+        response = self.execute_cached_query(query, variables, self.CACHE_TTLS["stopPlace"])
     
         if response["data"]["stopPlace"] is not None:
             return response["data"]["stopPlace"]
@@ -141,22 +268,16 @@ class EnturAPI:
             dict: Information about the line including its stops
         """
         
-        query = """
-        query GetLineInfo($lineId: ID!) {
-            line(id: $lineId) {
-                id
-                name
-                transportMode
-                quays {
-                    id
-                    name
-                }
-            }
-        }
+        query = f"""
+        query GetLineInfo($lineId: ID!) {{
+            line(id: $lineId) {{
+                {self.LINE_INFO_FIELDS}
+            }}
+        }}
         """
         variables = {"lineId": line_id}
         
-        response = self.execute_query(query, variables)
+        response = self.execute_cached_query(query, variables, self.CACHE_TTLS["line"])
 
         if response["data"]["line"] is not None:
             return response["data"]["line"]
@@ -209,35 +330,26 @@ class EnturAPI:
         Returns:
             dict: Information about journeys with real-time data
         """
-        query = """
-        query ($lineId: ID!) {
-            line(id: $lineId) {
-                id
-                name
-                transportMode
-                serviceJourneys {
-                    id
-                    estimatedCalls {
-                        actualArrivalTime
-                        actualDepartureTime
-                        aimedArrivalTime
-                        aimedDepartureTime
-                        expectedArrivalTime
-                        expectedDepartureTime
-                        realtime
-                        quay {
-                            name
-                        }
-                    }
-                }
-            }
-        }
-        """
-        
         variables = {"lineId": line_id}
-        response = self.execute_query(query, variables)
+        response = self.execute_query(self.REALTIME_JOURNEYS_QUERY, variables)
+
+        return self.filter_realtime_journeys(response)
+
+    @staticmethod
+    def filter_realtime_journeys(response: dict) -> dict:
+        """
+        Filter a realtime journeys response to only keep journeys, and calls, that have real-time data
+
+        Args:
+            response (dict): Response to REALTIME_JOURNEYS_QUERY
+
+        Returns:
+            dict: The data of the response, or None if the request failed or the line does not exist
+        """
+
+        if response is None:
+            return None
 
-        # Filter to only keep journeys that have any real-time data
         if response["data"]["line"] is not None:
             realtime_journeys = []
             for journey in response["data"]["line"]["serviceJourneys"]:
@@ -252,17 +364,171 @@ class EnturAPI:
             print("Error: LineID does not exist")
     
 
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                         BATCHED QUERIES                            ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def get_stops_info(self, stop_ids: list, batch_size: int = 50) -> dict:
+        """
+        Get information about many stops with as few requests as possible, see get_stop_info
+
+        Returns:
+            dict: Information about each stop by ID, None for stops that do not exist
+        """
+        return self.execute_batched("stopPlace", "String!", stop_ids, self.STOP_INFO_FIELDS, batch_size, ttl=self.CACHE_TTLS["stopPlace"])
+
+    def get_quays_info(self, quay_ids: list, batch_size: int = 50) -> dict:
+        """
+        Get the name, coordinates and stop place of many quays, e.g. the stopPointRef of the SIRI-ET data
+
+        Returns:
+            dict: Information about each quay by ID, None for quays that do not exist
+        """
+        return self.execute_batched("quay", "String!", quay_ids, self.QUAY_INFO_FIELDS, batch_size, ttl=self.CACHE_TTLS["quay"])
+
+    def get_lines_info(self, line_ids: list, batch_size: int = 50) -> dict:
+        """
+        Get information about many lines with as few requests as possible, see get_line_info
+
+        Returns:
+            dict: Information about each line by ID, None for lines that do not exist
+        """
+        return self.execute_batched("line", "ID!", line_ids, self.LINE_INFO_FIELDS, batch_size, ttl=self.CACHE_TTLS["line"])
+
+    def get_realtime_journeys_batch(self, line_ids: list, batch_size: int = 10) -> dict:
+        """
+        Get the journeys with real-time data of many lines with as few requests as possible, see get_realtime_journeys.
+        The default batch size is smaller, as each line returns its whole timetable.
+
+        Returns:
+            dict: Same data as get_realtime_journeys for each line ID, None for lines that failed or do not exist
+        """
+
+        lines = self.execute_batched("line", "ID!", line_ids, self.REALTIME_JOURNEYS_FIELDS, batch_size)
+
+        return {
+            line_id: self.filter_realtime_journeys({"data": {"line": line}}) if line is not None else None
+            for line_id, line in lines.items()
+        }
+
+    def execute_batched(self, field: str, id_type: str, ids: list, fields: str, batch_size: int = 50, max_query_bytes: int = 50_000, ttl: float = None) -> dict:
+        """
+        Look up many ids of the same root field with one request per batch, using GraphQL aliases:
+
+            query ($id0: ID!, $id1: ID!) {
+                r0: line(id: $id0) { ... }
+                r1: line(id: $id1) { ... }
+            }
+
+        Args:
+            field (str): Root query field, e.g. 'line' or 'stopPlace'
+            id_type (str): GraphQL type of the id argument, e.g. 'ID!'
+            ids (list): IDs to look up. Duplicates are only requested once
+            fields (str): Selection set of each lookup
+            batch_size (int): Maximum number of lookups per request
+            max_query_bytes (int): Maximum size of the query document of each request
+            ttl (float): Seconds each found result is cached. Default is no caching
+
+        Returns:
+            dict: Result for each ID, None if the ID does not exist or its request failed
+        """
+
+        results = {}
+        pending = []
+
+        #Each result is cached under its single-id query, so it is found whatever batch it is requested in
+        for id in dict.fromkeys(ids):
+            cached = self.cache.get(*self.build_batch_query(field, id_type, [id], fields)) if ttl else None
+            if cached is not None:
+                results[id] = cached
+            else:
+                pending.append(id)
+
+        for batch in self._split_batches(pending, fields, batch_size, max_query_bytes):
+            query, variables = self.build_batch_query(field, id_type, batch, fields)
+            response = self.execute_query(query, variables, partial=True)
+            data = (response or {}).get("data") or {}
+
+            for i, id in enumerate(batch):
+                results[id] = data.get(f"r{i}")
+
+                if ttl and results[id] is not None:
+                    self.cache.set(*self.build_batch_query(field, id_type, [id], fields), results[id], ttl)
+
+        return {id: results[id] for id in dict.fromkeys(ids)}
+
+    @staticmethod
+    def build_batch_query(field: str, id_type: str, ids: list, fields: str) -> tuple:
+        """
+        Builds a query document that looks up every id under its own alias r0, r1, ...
+
+        Returns:
+            tuple: Query string and variables
+        """
+
+        definitions = ", ".join(f"$id{i}: {id_type}" for i in range(len(ids)))
+        lookups = "\n".join(f"r{i}: {field}(id: $id{i}) {{ {fields} }}" for i in range(len(ids)))
+
+        query = f"query ({definitions}) {{\n{lookups}\n}}"
+        variables = {f"id{i}": id for i, id in enumerate(ids)}
+
+        return query, variables
+
+    def _split_batches(self, ids, fields, batch_size, max_query_bytes):
+        """Splits ids into batches of at most batch_size ids and max_query_bytes of query document"""
+
+        batch, size = [], 0
+
+        for id in ids:
+            item_size = len(fields) + len(id) + 40
+            if batch and (len(batch) >= batch_size or size + item_size > max_query_bytes):
+                yield batch
+                batch, size = [], 0
+
+            batch.append(id)
+            size += item_size
+
+        if batch:
+            yield batch
+
+
 class EnturSQL:
     """
     requires gcloud CLI to be installed and authenticated
 
     https://data.entur.no/domain/public-transport-data/product/realtime_siri_et/urn:li:container:1d391ef93913233c516cbadfb190dc65
     """
-    def __init__(self, project_id=None):
-            self.client = bigquery.Client(project=project_id)
+    def __init__(self, project_id=None, cache_dir=os.path.join(CACHE_DIR, "bigquery"), cache_bytes=2 * 1024**3, client=None):
+            """
+            Args:
+                project_id (str): Google Cloud project that is billed for the queries
+                cache_dir (str): Directory where results of queries of past dates are cached, default data/cache/bigquery in the project root. None disables the cache
+                cache_bytes (int): Maximum total size of the cached results
+                client: Client used by the streaming readers, e.g. a local fake. Default is a bigquery.Client
+            """
+            self.project_id = project_id
+            self._client = client
+            self.cache = QueryResultCache(cache_dir, cache_bytes) if cache_dir else None
             self.exceptions = ["recordedAtTime", "datedServiceJourneyId", "operatorRef", "vehicleMode", "dataSource", "dataSourceName"]
             self.table_id = "`ent-data-sharing-ext-prd.realtime_siri_et.realtime_siri_et_last_recorded`"
 
+            #Columns used by the pipeline, selected explicitly so only these are scanned. Kept as an explicit list,
+            #as a column declared in the schema but missing from the table would fail the whole query
+            self.columns = [
+                "lineRef", "directionRef", "operatingDate", "extraJourney", "journeyCancellation", "serviceJourneyId",
+                "sequenceNr", "stopPointRef", "stopPointName", "originName", "destinationName", "extraCall", "stopCancellation",
+                "aimedArrivalTime", "arrivalTime", "aimedDepartureTime", "departureTime",
+            ]
+
+    @property
+    def client(self):
+        """BigQuery client, created on first use so queries can be built without credentials"""
+
+        if self._client is None:
+            self._client = bigquery.Client(project=self.project_id)
+
+        return self._client
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                          SQL REQUESTS                              ║
     #╚════════════════════════════════════════════════════════════════════╝
@@ -279,11 +545,123 @@ class EnturSQL:
             '''
         return query
 
-    def query_to_dataframe(self, query):
+    def query_to_dataframe(self, query, use_cache=True):
         """
         Execute a SQL query against the BigQuery API and returns a DataFrame
+
+        Results of queries that only read past operating dates are cached locally, as those partitions do not change.
+        Queries that may read the current day always go to BigQuery.
+        """
+
+        if self.cache is None or not use_cache:
+            return pdgbq.read_gbq(query,dialect='standard', project_id=self.client.project)
+
+        if not self.cache.is_cacheable(query):
+            self.cache.bypassed += 1
+            return pdgbq.read_gbq(query,dialect='standard', project_id=self.client.project)
+
+        df = self.cache.get(query)
+        if df is None:
+            df = pdgbq.read_gbq(query,dialect='standard', project_id=self.client.project)
+            self.cache.set(query, df)
+
+        return df
+
+    def iter_query_batches(self, query, page_size=100_000, use_cache=True):
         """
-        return pdgbq.read_gbq(query,dialect='standard', project_id=self.client.project)
+        Execute a SQL query and yield the result while it is downloaded, instead of materialising it.
+        Cached results are read back from disk, and results of past dates are cached as they stream.
+
+        The client only needs client.query(query).result(page_size=...).to_arrow_iterable(),
+        as implemented by bigquery.Client.
+
+        Yields:
+            pyarrow.RecordBatch: Pages of the result
+        """
+
+        if self.cache is None or not use_cache or not self.cache.is_cacheable(query):
+            if self.cache is not None and use_cache:
+                self.cache.bypassed += 1
+            yield from self._stream(query, page_size)
+            return
+
+        batches = self.cache.iter_batches(query, page_size)
+        if batches is None:
+            batches = self.cache.write_batches(query, self._stream(query, page_size))
+
+        yield from batches
+
+    def iter_query_dataframes(self, query, max_rows=200_000, align_on=("operatingDate", "serviceJourneyId"), page_size=None, use_cache=True):
+        """
+        Execute a SQL query and yield the result as DataFrames of bounded size, see iter_query_batches.
+
+        Rows with the same align_on values are never split between DataFrames, e.g. a journey is always
+        processed as a whole. This requires the query to be ordered by the align_on columns.
+
+        Args:
+            query (str): SQL query ordered by align_on
+            max_rows (int): Number of rows after which a DataFrame is yielded. A DataFrame is larger
+                            if a group of align_on values continues past max_rows
+            align_on (tuple): Columns whose groups are kept together
+            page_size (int): Number of rows downloaded at a time. Default is max_rows
+
+        Yields:
+            dataframe: Consecutive parts of the result
+        """
+
+        align_on = list(align_on)
+        buffer, buffered = [], 0
+
+        for batch in self.iter_query_batches(query, page_size or max_rows, use_cache):
+            if batch.num_rows == 0:
+                continue
+
+            buffer.append(batch.to_pandas())
+            buffered += batch.num_rows
+
+            if buffered < max_rows:
+                continue
+
+            df = pd.concat(buffer, ignore_index=True)
+
+            #The last group may continue in the next batch, so it is held back
+            keys = df[align_on]
+            in_last_group = (keys == keys.iloc[-1]).all(axis=1).to_numpy()
+            split = len(df) - np.argmin(in_last_group[::-1]) if not in_last_group.all() else 0
+
+            if split > 0:
+                yield df.iloc[:split].reset_index(drop=True)
+
+            buffer = [df.iloc[split:].reset_index(drop=True)]
+            buffered = len(df) - split
+
+        if buffered:
+            yield pd.concat(buffer, ignore_index=True)
+
+    def _stream(self, query, page_size):
+        rows = self.client.query(query).result(page_size=page_size)
+
+        yield from rows.to_arrow_iterable()
+
+    def get_cache_stats(self):
+        """
+        Returns:
+            dict: Hits, misses and bypassed queries of the result cache, and its size
+        """
+        return self.cache.stats() if self.cache is not None else None
+
+    def estimate_bytes(self, query):
+        """
+        Dry-runs a SQL query
+
+        Returns:
+            int: Number of bytes the query would scan
+        """
+
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+        job = self.client.query(query, job_config=job_config)
+
+        return job.total_bytes_processed
 
     #╔════════════════════════════════════════════════════════════════════╗
     #║                          SQL QUERIES                               ║
@@ -361,10 +739,73 @@ class EnturSQL:
 
         return self.query_to_dataframe(query) if execute else query
     
+    def get_data_by_lineid_and_timewindows(self, line_id, start_date, end_date, windows, days_of_week = None, limit=None, execute = True):
+        """
+        Get the journeys that start their route within any of several timeframes, with one scan of the table.
+
+        Each row is tagged with the label of its window in the column targetTime. A journey within
+        overlapping windows is returned once, tagged with the window that starts first.
+        Rows are ordered by journey, so the result can be streamed journey by journey.
+
+        Args:
+            line_id (str): ID of the line
+            start_date (str): Format: YYYY-MM-DD
+            end_date (str): Format: YYYY-MM-DD
+            windows (dict): (start_time, end_time) in HH:MM:SS format by label. A window with
+                            start_time after end_time continues past midnight
+            days_of_week (list): Only include these days of the week (optional)
+            limit (int): Maximum number of rows (optional)
+            execute (bool): Run the query, else return it
+
+        Returns:
+            dataframe: Data of the journeys, or the query if execute is False
+        """
+
+        ordered = sorted(dict(windows).items(), key=lambda item: item[1][0])
+
+        cases = " ".join(
+            f'WHEN {self._time_condition("TIME(aimedDepartureTime)", start_time, end_time)} THEN "{label}"'
+            for label, (start_time, end_time) in ordered
+        )
+
+        day_condition = ""
+        if days_of_week:
+            day_condition = f"AND dayOfTheWeek IN ({self._list_to_string(days_of_week)})"
+
+        limit_clause = f"LIMIT {limit}" if limit else ""
+
+        #The window of a journey is given by the departure from its first stop, spread to all its stops
+        query = f'''
+            SELECT *
+            FROM (
+                SELECT
+                    {self._list_to_string(self.columns)},
+                    MAX(IF(sequenceNr = 1, CASE {cases} END, NULL))
+                        OVER (PARTITION BY operatingDate, serviceJourneyId) AS targetTime
+                FROM {self.table_id}
+                WHERE operatingDate BETWEEN "{start_date}" AND "{end_date}"
+                AND lineRef = "{line_id}"
+                {day_condition}
+            )
+            WHERE targetTime IS NOT NULL
+            ORDER BY operatingDate, serviceJourneyId, sequenceNr
+            {limit_clause}
+            '''
+
+        return self.query_to_dataframe(query) if execute else query
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                             HELPER                                 ║
     #╚════════════════════════════════════════════════════════════════════╝
 
+    def _time_condition(self, column, start_time, end_time):
+        """Condition that the time column is within the window, which may continue past midnight"""
+
+        if start_time <= end_time:
+            return f'{column} BETWEEN "{start_time}" AND "{end_time}"'
+
+        return f'({column} >= "{start_time}" OR {column} <= "{end_time}")'
+
     def _list_to_string(self, lst):
         return ", ".join([f"{item}" for item in lst])
     
@@ -1,4 +1,6 @@
 import requests
+from http_session import create_session, RequestStats, RateLimiter, count_retries
+import time
 import os
 from dotenv import load_dotenv
 
@@ -56,11 +58,29 @@ class FrostAPI:
     BASE_URL = 'https://frost.met.no/'
     OBSERVATIONS_PATH = 'observations/v0.jsonld'
     SOURCES_PATH = 'sources/v0.jsonld'
+    AVAILABLE_TIMESERIES_PATH = 'observations/availableTimeSeries/v0.jsonld'
 
-    def __init__(self):
+    #Maximum number of observations Frost returns in one response
+    MAX_OBSERVATIONS = 100_000
+
+    def __init__(self, pool_size=10, timeout=(5, 60), retries=5, backoff_factor=0.5, rate_limit=10):
+        """
+        Args:
+            pool_size (int): Number of keep-alive connections to the API
+            timeout (tuple): Connect and read timeout in seconds
+            retries (int): Maximum number of retries on connection errors and 429/5xx responses
+            backoff_factor (float): Base of the exponential backoff between retries in seconds
+            rate_limit (float): Maximum number of requests started per second, shared by all threads using the client
+        """
         self.client_id = os.getenv("FROST_CLIENT_ID")
         self.client_secret = os.getenv("FROST_CLIENT_SECRET")
 
+        self.timeout = timeout
+        self.session = create_session(pool_size, retries, backoff_factor)
+        self.session.auth = (self.client_id, '')
+        self.stats = RequestStats()
+        self.rate_limiter = RateLimiter(rate_limit)
+
     #╔════════════════════════════════════════════════════════════════════╗
     #║                          API REQUEST                               ║
     #╚════════════════════════════════════════════════════════════════════╝ 
@@ -76,21 +96,42 @@ class FrostAPI:
             dict: Response from the API
         """
         
+        self.rate_limiter.wait()
+
+        start = time.perf_counter()
+        response = None
+
         try:
-            response = requests.get(self.BASE_URL + url, params=parameters,  auth=(self.client_id,''))
+            response = self.session.get(self.BASE_URL + url, params=parameters, timeout=self.timeout)
+
+            #Frost answers valid requests without any matching data with 404
+            if response.status_code == 404:
+                self.stats.record(time.perf_counter() - start, True, count_retries(response))
+                return {"data": []}
+
             response.raise_for_status()
 
             result = response.json()
 
             if "error" in result:
                 print(f"{result['error']['code']} error: {result['error']['message']}. {result['error']['reason']}")
+                self.stats.record(time.perf_counter() - start, False, count_retries(response))
                 return None
             else:
+                self.stats.record(time.perf_counter() - start, True, count_retries(response))
                 return result
             
         except requests.exceptions.RequestException as e:
             print(f"Request failed: {str(e)}")
+            self.stats.record(time.perf_counter() - start, False, count_retries(response))
             return None
+
+    def get_request_stats(self) -> dict:
+        """
+        Returns:
+            dict: Number of requests, retries and failures, and average/max latency in seconds
+        """
+        return self.stats.summary()
         
     #╔════════════════════════════════════════════════════════════════════╗
     #║                          API QUERIES                               ║
@@ -103,7 +144,8 @@ class FrostAPI:
         Args:
             parameters: Dictionary containing parameters:
                 - sources (required): Weather station ID (e.g., 'SN18700' for Oslo-Blindern)
-                - elements (required): Comma-separated list of weather elements to fetch
+                - elements (required): Comma-separated list of weather elements to fetch. At most MAX_OBSERVATIONS
+                  observations are returned per request, across all elements
                 - referencetime (required): Time period for data (e.g., '2024-02-24/2024-02-25'). 'latest' returns the most recent data. 
                 - maxage: Maximum age of data, appliable only when referencetime is set to 'latest' (e.g. 'PT1H' for 1 hour.)
                 - limit: Maximum number of observations to return
@@ -111,7 +153,7 @@ class FrostAPI:
                 - timeresolutions: The period between each data value, i.e. data output frequency
 
         Returns:
-            Weather observations data or None if request failed
+            Weather observations data, with empty data if there are no observations, or None if request failed
         """
 
         url = self.OBSERVATIONS_PATH
@@ -143,6 +185,26 @@ class FrostAPI:
 
         return response
     
+    def get_available_timeseries(self, parameters: dict):
+        """
+        Get the time series that are available for stations and elements
+        
+        Args:
+            parameters: Dictionary containing filters such as:
+                - sources: Comma-separated list of weather station IDs
+                - elements: Comma-separated list of weather elements
+                - referencetime: Only time series with data in this period
+                
+        Returns:
+            Time series data or None if request failed
+        """
+
+        url = self.AVAILABLE_TIMESERIES_PATH
+
+        response = self.execute_query(parameters, url)
+
+        return response
+
     def test_connection(self) -> bool:
         """
         Test the connection to the Frost API
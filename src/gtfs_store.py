@@ -0,0 +1,241 @@
+from schemas import GTFS_TRIPS_SCHEMA, GTFS_STOP_TIMES_SCHEMA, GTFS_STOPS_SCHEMA, csv_dtypes
+import pandas as pd
+import numpy as np
+import json
+import os
+
+class GTFSStore:
+    """
+    Compact on-disk store of the GTFS trips and stop times.
+
+    The GTFS text files are imported once into flat numpy arrays:
+        - Ids are int-coded against dictionaries of route, trip and stop ids
+        - Stop times are stored as seconds since midnight (-1 when missing)
+        - Trips are ordered by route and stop times by trip and stop sequence, so
+          route_trip_ptr[r]:route_trip_ptr[r+1] are the trips of route r and
+          trip_stop_ptr[t]:trip_stop_ptr[t+1] are the stop times of trip t
+
+    The arrays are memory-mapped when opened, so lookups only read the slices they need.
+    """
+
+    ARRAYS = [
+        'route_ids', 'trip_ids', 'stop_ids',
+        'route_trip_ptr', 'trip_stop_ptr',
+        'stop_code', 'stop_sequence', 'arrival_time', 'departure_time',
+    ]
+    SOURCE_FILES = ['trips.txt', 'stop_times.txt', 'stops.txt']
+
+    def __init__(self, gtfs_dir, store_dir, chunksize = 1_000_000):
+        """
+        Args:
+            gtfs_dir (str): Directory with the GTFS text files
+            store_dir (str): Directory where the imported arrays are stored
+            chunksize (int): Number of stop time rows read at a time during import
+        """
+        self.gtfs_dir = gtfs_dir
+        self.store_dir = store_dir
+        self.chunksize = chunksize
+
+        self.arrays = None
+        self._route_index = None
+        self._trip_index = None
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             IMPORT                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def open(self):
+        """Opens the store, importing the GTFS files first if the store is missing or outdated"""
+
+        if not self.is_current():
+            self.build()
+
+        self.arrays = {name: np.load(os.path.join(self.store_dir, name + '.npy'), mmap_mode='r') for name in self.ARRAYS}
+        self._route_index = None
+        self._trip_index = None
+
+        return self
+
+    def is_current(self):
+        """Checks that the store exists and was built from the current GTFS files"""
+
+        meta_path = os.path.join(self.store_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path) as file:
+            meta = json.load(file)
+
+        return meta.get('sources') == self._source_signature()
+
+    def build(self):
+        """Imports trips.txt, stop_times.txt and stops.txt into the store"""
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        trip_columns = ['route_id', 'trip_id']
+        trips = pd.read_csv(os.path.join(self.gtfs_dir, 'trips.txt'), usecols=trip_columns, dtype=csv_dtypes(GTFS_TRIPS_SCHEMA, trip_columns))
+        stop_ids = pd.read_csv(os.path.join(self.gtfs_dir, 'stops.txt'), usecols=['stop_id'], dtype=csv_dtypes(GTFS_STOPS_SCHEMA, ['stop_id']))['stop_id']
+
+        #Orders trips by route so each route owns a contiguous range of trips
+        route_codes, route_ids = pd.factorize(trips['route_id'], sort=True)
+        order = np.argsort(route_codes, kind='stable')
+        trip_ids = trips['trip_id'].to_numpy()[order]
+        route_trip_ptr = np.concatenate([[0], np.cumsum(np.bincount(route_codes, minlength=len(route_ids)))])
+
+        trip_index = pd.Index(trip_ids)
+        stop_index = pd.Index(stop_ids)
+
+        parts = {'trip': [], 'stop_code': [], 'stop_sequence': [], 'arrival_time': [], 'departure_time': []}
+
+        stop_time_columns = ['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence']
+        reader = pd.read_csv(
+            os.path.join(self.gtfs_dir, 'stop_times.txt'),
+            usecols=stop_time_columns,
+            dtype=csv_dtypes(GTFS_STOP_TIMES_SCHEMA, stop_time_columns),
+            chunksize=self.chunksize,
+        )
+
+        for chunk in reader:
+            trip_pos = trip_index.get_indexer(chunk['trip_id'])
+            keep = trip_pos >= 0
+
+            parts['trip'].append(trip_pos[keep].astype(np.int32))
+            parts['stop_code'].append(stop_index.get_indexer(chunk['stop_id'])[keep].astype(np.int32))
+            parts['stop_sequence'].append(chunk['stop_sequence'].to_numpy()[keep])
+            parts['arrival_time'].append(self.time_to_seconds(chunk['arrival_time'])[keep])
+            parts['departure_time'].append(self.time_to_seconds(chunk['departure_time'])[keep])
+
+        columns = {name: np.concatenate(values) for name, values in parts.items()}
+
+        #Orders stop times by trip and sequence so each trip owns a contiguous range of stop times
+        order = np.lexsort((columns['stop_sequence'], columns['trip']))
+        trip_stop_ptr = np.concatenate([[0], np.cumsum(np.bincount(columns['trip'], minlength=len(trip_ids)))])
+
+        arrays = {
+            'route_ids': np.asarray(route_ids, dtype=str),
+            'trip_ids': np.asarray(trip_ids, dtype=str),
+            'stop_ids': np.asarray(stop_ids, dtype=str),
+            'route_trip_ptr': route_trip_ptr.astype(np.int64),
+            'trip_stop_ptr': trip_stop_ptr.astype(np.int64),
+            'stop_code': columns['stop_code'][order],
+            'stop_sequence': columns['stop_sequence'][order],
+            'arrival_time': columns['arrival_time'][order],
+            'departure_time': columns['departure_time'][order],
+        }
+
+        for name, array in arrays.items():
+            np.save(os.path.join(self.store_dir, name + '.npy'), array)
+
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w') as file:
+            json.dump({'sources': self._source_signature(), 'stop_times': int(len(order))}, file)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             LOOKUPS                                ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def get_trips(self, route_id):
+        """
+        Get the trip IDs of a route
+
+        Args:
+            route_id (str): The route ID to find trips of
+
+        Returns:
+            list: Trip IDs of the route, empty if the route is unknown
+        """
+
+        start, end = self._route_trip_range(route_id)
+
+        return self.arrays['trip_ids'][start:end].tolist()
+
+    def get_trips_by_timeframes(self, route_id, time_frames):
+        """
+        Get unique trip IDs of a route with an arrival within any of the timeframes
+
+        Args:
+            route_id (str): The route ID to filter by
+            time_frames (list): List of (start_time, end_time) tuples in HH:MM:SS format
+
+        Returns:
+            list: Unique trip IDs that operate within any of the given timeframes
+        """
+
+        trip_start, trip_end = self._route_trip_range(route_id)
+        trip_stop_ptr = self.arrays['trip_stop_ptr']
+
+        #The stop times of a route are contiguous since trips are ordered by route
+        start, end = trip_stop_ptr[trip_start], trip_stop_ptr[trip_end]
+        arrivals = np.asarray(self.arrays['arrival_time'][start:end])
+
+        mask = np.zeros(len(arrivals), dtype=bool)
+        for start_time, end_time in time_frames:
+            lower, upper = self.time_to_seconds(pd.Series([start_time, end_time]))
+            mask |= (arrivals >= lower) & (arrivals <= upper)
+
+        rows = np.flatnonzero(mask) + start
+        trips = np.unique(np.searchsorted(trip_stop_ptr, rows, side='right') - 1)
+
+        return self.arrays['trip_ids'][trips].tolist()
+
+    def get_stop_times(self, trip_id):
+        """
+        Get the stop times of a trip
+
+        Args:
+            trip_id (str): The trip ID
+
+        Returns:
+            dataframe: Stop id, sequence and arrival/departure in seconds since midnight.
+                       The stop id is missing for stops that are not in stops.txt
+        """
+
+        if self._trip_index is None:
+            self._trip_index = pd.Index(self.arrays['trip_ids'])
+
+        trip = self._trip_index.get_indexer([trip_id])[0]
+        if trip < 0:
+            return None
+
+        start, end = self.arrays['trip_stop_ptr'][trip], self.arrays['trip_stop_ptr'][trip + 1]
+
+        #Stops missing from stops.txt have code -1
+        stop_codes = self.arrays['stop_code'][start:end]
+        stop_ids = pd.Series(self.arrays['stop_ids'][stop_codes], dtype=object).where(stop_codes >= 0)
+
+        return pd.DataFrame({
+            'stop_id': stop_ids,
+            'stop_sequence': self.arrays['stop_sequence'][start:end],
+            'arrival_time': self.arrays['arrival_time'][start:end],
+            'departure_time': self.arrays['departure_time'][start:end],
+        })
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             HELPER                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    @staticmethod
+    def time_to_seconds(times):
+        """Converts GTFS HH:MM:SS times (hours may exceed 24) to seconds since midnight, -1 if missing"""
+
+        seconds = pd.to_timedelta(times).dt.total_seconds()
+
+        return seconds.fillna(-1).to_numpy(dtype=np.int32)
+
+    def _route_trip_range(self, route_id):
+        if self._route_index is None:
+            self._route_index = {route: i for i, route in enumerate(self.arrays['route_ids'].tolist())}
+
+        route = self._route_index.get(route_id)
+        if route is None:
+            return 0, 0
+
+        return self.arrays['route_trip_ptr'][route], self.arrays['route_trip_ptr'][route + 1]
+
+    def _source_signature(self):
+        signature = {}
+        for name in self.SOURCE_FILES:
+            stat = os.stat(os.path.join(self.gtfs_dir, name))
+            signature[name] = [stat.st_size, int(stat.st_mtime)]
+
+        return signature
@@ -0,0 +1,126 @@
+'''
+Shared HTTP plumbing for the API clients: pooled keep-alive sessions with retries, rate limiting and request counters.
+'''
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def create_session(pool_size = 10, retries = 5, backoff_factor = 0.5, backoff_jitter = 0.5, headers = None):
+    """
+    Creates a session that reuses connections and retries transient failures
+
+    Retries use exponential backoff (backoff_factor * 2^retry seconds) plus up to backoff_jitter seconds of random jitter,
+    and wait as long as the server asks in a Retry-After header for 429 and 503 responses.
+    POST is retried too, as the GraphQL requests of the clients only read data.
+
+    Args:
+        pool_size (int): Number of keep-alive connections kept per host
+        retries (int): Maximum number of retries per request
+        backoff_factor (float): Base of the exponential backoff in seconds
+        backoff_jitter (float): Maximum random jitter added to each backoff in seconds
+        headers (dict): Headers sent with every request
+
+    Returns:
+        requests.Session
+    """
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_jitter,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET', 'POST']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if headers:
+        session.headers.update(headers)
+
+    return session
+
+
+class RequestStats:
+    """Thread-safe request, retry, failure and latency counters of a client"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.failures = 0
+            self.total_seconds = 0.0
+            self.max_seconds = 0.0
+
+    def record(self, seconds, success = True, retries = 0):
+        """
+        Records a finished request
+
+        Args:
+            seconds (float): Wall time of the request, including retries
+            success (bool): False if the request failed
+            retries (int): Number of retries the request needed
+        """
+
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.failures += 0 if success else 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def summary(self):
+        """
+        Returns:
+            dict: Counters and average/max latency in seconds
+        """
+
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'failures': self.failures,
+                'avg_latency': self.total_seconds / self.requests if self.requests else 0.0,
+                'max_latency': self.max_seconds,
+            }
+
+
+class RateLimiter:
+    """Thread-safe limiter that spaces out requests so that at most rate requests are started per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+def count_retries(response):
+    """Number of retries urllib3 needed for a response"""
+
+    retries = getattr(getattr(response, 'raw', None), 'retries', None)
+
+    return len(retries.history) if retries is not None else 0
@@ -2,6 +2,9 @@ from entur_data import EnturAPI, EnturSQL
 from frostapi import FrostAPI
 from data_fetcher import DataFetcher
 from data_handler import DataHandler
+from schemas import ENTUR_RAW_SCHEMA
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
 
 
 def main(route_id, start_date, end_date, target_times):
@@ -29,12 +32,130 @@ def main(route_id, start_date, end_date, target_times):
     weather_data = fetcher.collect_weather_data(start_date, end_date, save_to_csv=True)
 
 
-def data_cleaning(df):
-    #Removes empty features
-    df = handler.remove_missing_values(df)
+def main_incremental(route_id, start_date, end_date, target_times, refresh_days = 2, window_minutes = 5):
+    """
+    Processes only the operating dates that are missing from the processed store, were processed with other target times
+    or windows, or whose data has changed.
+    Raw and processed data are appended to partitioned parquet datasets, and the processed dates are recorded in the manifest.
+    """
+
+    selection = handler.selection_key(target_times, window_minutes)
+    pending_dates = handler.get_pending_dates(route_id, start_date, end_date, refresh_days, selection)
+
+    if not pending_dates:
+        print(f"All operating dates for {route_id} between {start_date} and {end_date} are already processed")
+        return
+
+    for run_start, run_end in handler.group_date_ranges(pending_dates):
+        run_dates = [date for date in pending_dates if run_start <= date <= run_end]
+        process_date_range(route_id, run_start, run_end, run_dates, target_times, window_minutes)
+
+
+def main_backfill(route_ids, start_date, end_date, target_times, shard = 'month', max_workers = 4, refresh_days = 2, window_minutes = 5):
+    """
+    Processes a long date range for many lines as week or month shards, running up to max_workers shards in parallel.
+    Each finished shard is checkpointed in the manifest, so a failed or interrupted backfill resumes with only the shards that are left.
+    """
+
+    if isinstance(route_ids, str):
+        route_ids = [route_ids]
+
+    selection = handler.selection_key(target_times, window_minutes)
+
+    jobs = []
+    for route_id in route_ids:
+        pending_dates = handler.get_pending_dates(route_id, start_date, end_date, refresh_days, selection)
+
+        for shard_start, shard_end in handler.shard_date_ranges(pending_dates, shard):
+            shard_dates = [date for date in pending_dates if shard_start <= date <= shard_end]
+            jobs.append((route_id, shard_start, shard_end, shard_dates))
+
+    if not jobs:
+        print(f"All operating dates between {start_date} and {end_date} are already processed")
+        return
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_date_range, *job, target_times, window_minutes): job for job in jobs}
+
+        for future in as_completed(futures):
+            route_id, shard_start, shard_end, _ = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"Failed {route_id} from {shard_start} to {shard_end}: {e}")
+
+    print(f"Backfilled {len(jobs) - len(failed)} of {len(jobs)} shards")
+    if failed:
+        print("Run the backfill again to retry the failed shards")
+
+
+def process_date_range(route_id, start_date, end_date, dates, target_times, window_minutes = 5):
+    """
+    Fetches, cleans and feature engineers the data of a line in a date range, and records the dates in the manifest.
+    Dates are only recorded once their data is saved, so an interrupted range is processed again on the next run.
+    """
+
+    selection = handler.selection_key(target_times, window_minutes)
+    raw_data = fetcher.get_data_SQL(route_id, start_date, end_date, target_times, window_minutes)
 
-    #Converts features with dates into datetime-format for simpler calculation
-    df = handler.convert_date_to_datetime(df, ['aimedArrivalTime','arrivalTime','aimedDepartureTime','departureTime'])
+    #Dates without data may still hold rows of an earlier run with other target times or windows
+    data_dates = set() if raw_data is None or raw_data.empty else set(pd.to_datetime(raw_data['operatingDate']).dt.strftime('%Y-%m-%d'))
+    handler.clear_entur_partitions(route_id, [date for date in dates if date not in data_dates])
+
+    if raw_data is None or raw_data.empty:
+        handler.update_manifest(route_id, dates, selection=selection)
+        return
+
+    #Skips dates where the refetched data is identical to the processed data
+    changed_data = handler.get_changed_partitions(route_id, raw_data, selection)
+
+    if not changed_data.empty:
+        handler.save_raw_entur_data(changed_data, handler.entur_dataset, storage='parquet')
+
+        cleaned_data = data_cleaning(changed_data, drop_empty_columns=False)
+        processed_data = feature_engineering(cleaned_data)
+
+        handler.save_processed_entur_data(processed_data, handler.entur_dataset, storage='parquet')
+        handler.save_stop_pair_partials(processed_data)
+
+    handler.update_manifest(route_id, dates, raw_data, selection)
+    print(f"Processed {route_id} from {start_date} to {end_date}")
+
+
+def main_streaming(route_ids, start_date, end_date, target_times, max_rows = 200_000, window_minutes = 5):
+    """
+    Processes the data while it is downloaded, in parts of whole operating dates, so peak memory is bounded by the part size and not the date range.
+    Each part is cleaned, feature engineered and appended to the partitioned parquet datasets before the next one is read.
+    """
+
+    if isinstance(route_ids, str):
+        route_ids = [route_ids]
+
+    selection = handler.selection_key(target_times, window_minutes)
+
+    for route_id in route_ids:
+        for raw_data in fetcher.stream_data_SQL(route_id, start_date, end_date, target_times, window_minutes, max_rows=max_rows):
+            handler.save_raw_entur_data(raw_data, handler.entur_dataset, storage='parquet')
+
+            cleaned_data = data_cleaning(raw_data, drop_empty_columns=False)
+            processed_data = feature_engineering(cleaned_data)
+
+            handler.save_processed_entur_data(processed_data, handler.entur_dataset, storage='parquet')
+            handler.save_stop_pair_partials(processed_data)
+
+            chunk_dates = pd.to_datetime(raw_data['operatingDate']).dt.strftime('%Y-%m-%d').unique().tolist()
+            handler.update_manifest(route_id, chunk_dates, raw_data, selection)
+
+
+def data_cleaning(df, drop_empty_columns = True):
+    #Removes empty features. Disabled when partitions are stored separately, to keep the same columns in every partition
+    if drop_empty_columns:
+        df = handler.remove_missing_values(df)
+
+    #Converts the columns to the declared SIRI-ET types, e.g. dates into datetime-format for simpler calculation
+    df = handler.apply_schema(df, ENTUR_RAW_SCHEMA)
 
     #Merges duplicated arrival and departure times
     df = handler.merge_duplicated_stop_times(df)
@@ -42,17 +163,11 @@ def data_cleaning(df):
     return df
 
 def feature_engineering(df):
-    #Creates new features corresponding to the next stop
-    df = handler.append_next_stop(df)
-
-    #Calculate delay between true stop time and aimed stop time
-    df = handler.calculate_delay(df)
-
-    #
-    df = handler.calculate_delay_change(df)
+    #Creates next stop, delay, delay change and time between stops features in a single sorted pass
+    df = handler.engineer_journey_features(df)
 
-    #Calculates average time between stops
-    df = handler.calculate_time_between_stops(df)
+    #Stores the time of day as seconds since midnight for fast time filtering
+    df = handler.append_time_of_day(df)
 
     return df
 
@@ -99,6 +214,9 @@ if __name__ == "__main__":
 
     if connection:
         #main(bus_route, start_date, end_date, target_times)
+        #main_incremental(bus_route, start_date, end_date, target_times)
+        #main_streaming(bus_route, start_date, end_date, target_times)
+        #main_backfill([bus_route], start_date, end_date, target_times, shard='month')
         
         df = handler.load_processed_entur_data("rut-line-34_2024-01-01-2024-12-31_20250306_160847_processed.csv")
         df = feature_engineering(df)
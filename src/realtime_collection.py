@@ -0,0 +1,172 @@
+'''
+State of the realtime journeys of a line between polls of the journey planner.
+'''
+
+import pandas as pd
+import numpy as np
+
+
+class JourneyTracker:
+    """
+    Tracks which calls of each journey of a line have been emitted, so each poll only yields the calls
+    that departed since the previous poll.
+
+    Calls are identified by their stopPositionInPattern, which does not depend on which calls of the
+    journey have real-time data. The realtime subset of a journey can change between polls (a call
+    gets real-time data late, or loses it), so positions in the filtered call list are not stable.
+
+    Only journeys on the way keep their set of emitted positions. A journey is finalized once every call
+    has departed: its positions are dropped and it is skipped in later polls. Journeys are forgotten when
+    they no longer appear in the responses.
+    """
+
+    def __init__(self, evict_after = 2):
+        """
+        Args:
+            evict_after (int): Number of polls a journey may be missing from the responses before it is forgotten
+        """
+        self.evict_after = evict_after
+
+        self.emitted = {}
+        self.finished = set()
+        self.last_seen = {}
+        self.polls = 0
+
+    def update(self, data):
+        """
+        Finds the calls departed since the previous poll
+
+        Args:
+            data (dict): Response from get_realtime_journeys
+
+        Returns:
+            list: (journey, call, sequence number) of each newly departed call, in journey and call order.
+                  The sequence number is the position of the call in the journey pattern, starting at 1
+        """
+
+        self.polls += 1
+        new_calls = []
+
+        for journey in data['line']['serviceJourneys']:
+            journey_id = journey['id']
+            self.last_seen[journey_id] = self.polls
+
+            if journey_id in self.finished:
+                continue
+
+            calls = journey['estimatedCalls']
+            emitted = self.emitted.get(journey_id, set())
+            departed = 0
+
+            for call in calls:
+                if call['actualDepartureTime'] is None:
+                    continue
+
+                departed += 1
+                position = call['stopPositionInPattern']
+                if position not in emitted:
+                    emitted.add(position)
+                    new_calls.append((journey, call, position + 1))
+
+            if departed == len(calls):
+                self.finished.add(journey_id)
+                self.emitted.pop(journey_id, None)
+            elif departed > 0:
+                self.emitted[journey_id] = emitted
+
+        self._evict()
+
+        return new_calls
+
+    def active_journeys(self):
+        """Number of journeys that have departed but not finished"""
+        return len(self.emitted)
+
+    def _evict(self):
+        cutoff = self.polls - self.evict_after
+
+        for journey_id in [id for id, seen in self.last_seen.items() if seen <= cutoff]:
+            del self.last_seen[journey_id]
+            self.emitted.pop(journey_id, None)
+            self.finished.discard(journey_id)
+
+
+class JourneyBatch:
+    """
+    Columnar accumulator of the calls of one poll, across all journeys of a line.
+
+    Calls are appended field by field into column lists, and converted to one frame with a
+    single timestamp parse for all time columns.
+    """
+
+    TIME_FIELDS = [
+        'actualArrivalTime', 'actualDepartureTime',
+        'aimedArrivalTime', 'aimedDepartureTime',
+        'expectedArrivalTime', 'expectedDepartureTime',
+    ]
+    #Buses arrive and depart at the same time, so only departures are kept
+    BUS_TIME_FIELDS = ['actualArrivalTime', 'actualDepartureTime', 'aimedDepartureTime', 'expectedDepartureTime']
+
+    def __init__(self, transport_mode):
+        """
+        Args:
+            transport_mode (str): Mode of transport of the line (e.g., 'bus')
+        """
+        self.time_fields = self.BUS_TIME_FIELDS if transport_mode == 'bus' else self.TIME_FIELDS
+
+        self.times = {field: [] for field in self.time_fields}
+        self.ids = []
+        self.stops = []
+        self.sequence_nrs = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, journey_id, call, sequence_nr):
+        """
+        Args:
+            journey_id (str): ID of the journey
+            call (dict): Estimated call from the Entur API
+            sequence_nr (int): Position of the call in the journey pattern, starting at 1
+        """
+
+        for field in self.time_fields:
+            self.times[field].append(call[field])
+
+        self.ids.append(journey_id)
+        self.stops.append(call['quay']['name'])
+        self.sequence_nrs.append(sequence_nr)
+
+    def extend(self, calls):
+        """Appends (journey, call, sequence number) tuples, as returned by JourneyTracker.update"""
+
+        for journey, call, sequence_nr in calls:
+            self.append(journey['id'], call, sequence_nr)
+
+    def to_frame(self, line_id = None, collection_time = None):
+        """
+        Args:
+            line_id (str): Added as lineRef if given
+            collection_time (datetime): Added as collectionTime if given
+
+        Returns:
+            dataframe: One row per call
+        """
+
+        n = len(self.ids)
+
+        #All time columns are parsed as one array and split afterwards
+        flat = [time for field in self.time_fields for time in self.times[field]]
+        parsed = pd.to_datetime(pd.Series(flat, dtype=object), format='ISO8601', utc=True).array
+
+        df = pd.DataFrame({field: parsed[i * n:(i + 1) * n] for i, field in enumerate(self.time_fields)})
+        df['id'] = self.ids
+        df['stop'] = self.stops
+        df['sequenceNr'] = np.asarray(self.sequence_nrs, dtype=np.int32)
+
+        if line_id is not None:
+            df['lineRef'] = line_id
+        if collection_time is not None:
+            df['collectionTime'] = collection_time
+
+        return df
@@ -0,0 +1,366 @@
+'''
+Caches of API responses and query results.
+
+ResponseCache: Two-tier cache of API responses, an in-memory LRU in front of a disk store of JSON files.
+Entries are keyed by the normalized query (whitespace collapsed) and its variables, and expire after a per-entry TTL.
+
+QueryResultCache: Disk store of SQL query results as compressed parquet files, keyed by the normalized SQL.
+Results never expire, as they are only cached for queries of settled past dates.
+'''
+
+from collections import OrderedDict
+from datetime import date, timedelta
+import pyarrow.parquet as pq
+import pandas as pd
+import hashlib
+import re
+import threading
+import json
+import time
+import os
+
+#Default location of the caches, data/cache in the project root
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'cache')
+
+
+class ResponseCache:
+    """Thread-safe TTL cache of JSON-serializable responses"""
+
+    def __init__(self, cache_dir = None, max_entries = 256):
+        """
+        Args:
+            cache_dir (str): Directory of the disk store. None keeps the cache in memory only
+            max_entries (int): Maximum number of entries kept in memory
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                          GET / SET                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def get(self, query, variables = None):
+        """
+        Returns:
+            The cached response, or None if it is missing or expired
+        """
+
+        key = self.key(query, variables)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry['expires'] > now:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry['value']
+
+        entry = self._read(key)
+        if entry is not None and entry['expires'] > now:
+            with self._lock:
+                self._remember(key, entry)
+                self.disk_hits += 1
+            return entry['value']
+
+        with self._lock:
+            self._memory.pop(key, None)
+            self.misses += 1
+
+        if entry is not None:
+            self._delete(key)
+
+        return None
+
+    def set(self, query, variables, value, ttl):
+        """
+        Args:
+            query (str): Query string
+            variables (dict): Variables of the query
+            value: JSON-serializable response
+            ttl (float): Seconds until the entry expires
+        """
+
+        key = self.key(query, variables)
+        entry = {'expires': time.time() + ttl, 'value': value}
+
+        with self._lock:
+            self._remember(key, entry)
+
+        if self.cache_dir:
+            path = self._path(key)
+            with open(path + '.tmp', 'w') as file:
+                json.dump(entry, file)
+            os.replace(path + '.tmp', path)
+
+    def invalidate(self, query = None, variables = None):
+        """Removes one entry, or every entry if no query is given"""
+
+        if query is not None:
+            key = self.key(query, variables)
+            with self._lock:
+                self._memory.pop(key, None)
+            self._delete(key)
+            return
+
+        with self._lock:
+            self._memory.clear()
+
+        if self.cache_dir:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.json'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             STATS                                  ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def reset_stats(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: Memory hits, disk hits, misses, hit rate and number of entries in memory
+        """
+
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                'entries': len(self._memory),
+            }
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             HELPER                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    @staticmethod
+    def key(query, variables = None):
+        """Hash of the query with collapsed whitespace and its variables in sorted order"""
+
+        normalized = ' '.join(query.split())
+        payload = json.dumps([normalized, variables or {}], sort_keys=True)
+
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _read(self, key):
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self._path(key)) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _delete(self, key):
+        if not self.cache_dir:
+            return
+
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class QueryResultCache:
+    """Size-bounded, least recently used disk cache of SQL query results"""
+
+    DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+    #Days before a date is settled, late SIRI data can still arrive for the previous day
+    SETTLED_AFTER_DAYS = 2
+
+    def __init__(self, cache_dir = os.path.join(CACHE_DIR, 'bigquery'), max_bytes = 2 * 1024**3):
+        """
+        Args:
+            cache_dir (str): Directory of the result files
+            max_bytes (int): Maximum total size of the result files. The least recently used results are evicted first
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, query):
+        """
+        Returns:
+            dataframe: The cached result, or None if it is not cached
+        """
+
+        path = self._path(query)
+
+        #The file can be evicted by another thread between the read and the touch, which counts as a miss
+        try:
+            df = pd.read_parquet(path)
+
+            #The modification time orders the files by last use
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return df
+
+    def set(self, query, df):
+        """Stores the result of a query and evicts the least recently used results beyond max_bytes"""
+
+        path = self._path(query)
+        df.to_parquet(path + '.tmp', compression='zstd', index=False)
+        os.replace(path + '.tmp', path)
+
+        self._evict()
+
+    def iter_batches(self, query, batch_size = 100_000):
+        """
+        Reads a cached result in record batches
+
+        Returns:
+            iterator: pyarrow.RecordBatch of at most batch_size rows, or None if the result is not cached
+        """
+
+        path = self._path(query)
+
+        try:
+            file = pq.ParquetFile(path)
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return file.iter_batches(batch_size=batch_size)
+
+    def write_batches(self, query, batches):
+        """
+        Passes record batches through while writing them to the cache.
+        The result is only stored if every batch was consumed.
+
+        Yields:
+            pyarrow.RecordBatch
+        """
+
+        path = self._path(query)
+        writer = None
+
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pq.ParquetWriter(path + '.tmp', batch.schema, compression='zstd')
+                writer.write_batch(batch)
+                yield batch
+        except BaseException:
+            if writer is not None:
+                writer.close()
+                os.remove(path + '.tmp')
+            raise
+
+        if writer is not None:
+            writer.close()
+            os.replace(path + '.tmp', path)
+            self._evict()
+
+    def is_cacheable(self, query, today = None):
+        """
+        Checks that every date in the query is at least SETTLED_AFTER_DAYS days before today.
+        Queries without dates may read the current day, and are never cached.
+        """
+
+        cutoff = ((today or date.today()) - timedelta(days=self.SETTLED_AFTER_DAYS - 1)).isoformat()
+        dates = self.DATE_PATTERN.findall(query)
+
+        return bool(dates) and max(dates) < cutoff
+
+    def invalidate(self, query = None):
+        """Removes one result, or every result if no query is given"""
+
+        paths = [self._path(query)] if query is not None else [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.parquet')
+        ]
+
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hits, misses, bypassed queries, number of results and their total size in bytes
+        """
+
+        files = self._files()
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'results': len(files),
+                'bytes': sum(size for _, size, _ in files),
+            }
+
+    @staticmethod
+    def key(query):
+        """Hash of the query with collapsed whitespace"""
+        return hashlib.sha256(' '.join(query.split()).encode()).hexdigest()
+
+    def _path(self, query):
+        return os.path.join(self.cache_dir, self.key(query) + '.parquet')
+
+    def _files(self):
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.parquet'):
+                stat = entry.stat()
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+
+        return files
+
+    def _evict(self):
+        files = sorted(self._files(), key=lambda file: file[2])
+        total = sum(size for _, size, _ in files)
+
+        for path, size, _ in files:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,144 @@
+'''
+Declared column types of the Entur SIRI-ET, Frost and GTFS frames.
+
+Each column maps to a spec with a dtype and, for temporal columns, a fixed format and timezone.
+The dtypes are the pandas dtypes used when reading csv-files, except for:
+    - datetime: Timestamps parsed with the given format and converted to the given timezone
+    - date: Dates parsed with the given format, without timezone
+    - timedelta: Durations as written by pandas (e.g. '0 days 00:01:30')
+
+Columns that are not declared are left as they are loaded.
+'''
+
+TIMESTAMP = {'dtype': 'datetime', 'format': 'ISO8601', 'tz': 'UTC'}
+DATE = {'dtype': 'date', 'format': '%Y-%m-%d'}
+DURATION = {'dtype': 'timedelta'}
+STRING = {'dtype': 'str'}
+INTEGER = {'dtype': 'Int64'}
+FLOAT = {'dtype': 'float64'}
+BOOLEAN = {'dtype': 'boolean'}
+
+
+#╔════════════════════════════════════════════════════════════════════╗
+#║                          ENTUR SIRI-ET                             ║
+#╚════════════════════════════════════════════════════════════════════╝
+
+#realtime_siri_et_last_recorded, see EnturSQL
+ENTUR_RAW_SCHEMA = {
+    'recordedAtTime': TIMESTAMP,
+    'lineRef': STRING,
+    'directionRef': STRING,
+    'operatingDate': DATE,
+    'vehicleMode': STRING,
+    'extraJourney': BOOLEAN,
+    'journeyCancellation': BOOLEAN,
+    'serviceJourneyId': STRING,
+    'datedServiceJourneyId': STRING,
+    'operatorRef': STRING,
+    'dataSource': STRING,
+    'dataSourceName': STRING,
+    'sequenceNr': INTEGER,
+    'stopPointRef': STRING,
+    'stopPointName': STRING,
+    'originName': STRING,
+    'destinationName': STRING,
+    'extraCall': BOOLEAN,
+    'stopCancellation': BOOLEAN,
+    'aimedArrivalTime': TIMESTAMP,
+    'arrivalTime': TIMESTAMP,
+    'aimedDepartureTime': TIMESTAMP,
+    'departureTime': TIMESTAMP,
+}
+
+#Features added by DataHandler during cleaning and feature engineering
+ENTUR_PROCESSED_SCHEMA = {
+    **ENTUR_RAW_SCHEMA,
+    'targetTime': STRING,
+    'stopTime': TIMESTAMP,
+    'aimedStopTime': TIMESTAMP,
+    'aimedStopTimeOfDay': {'dtype': 'int32'},
+    'nextSequenceNr': INTEGER,
+    'nextStopPointName': STRING,
+    'stopDuration': DURATION,
+    'aimedStopDuration': DURATION,
+    'delay': DURATION,
+    'delayMinutes': FLOAT,
+    'arrivalDelay': DURATION,
+    'departureDelay': DURATION,
+    'arrivalDelayMinutes': FLOAT,
+    'departureDelayMinutes': FLOAT,
+    'delayChange': FLOAT,
+    'timeToNextStop': DURATION,
+    'aimedTimeToNextStop': DURATION,
+    'timeToNextStopMinutes': FLOAT,
+    'aimedTimeToNextStopMinutes': FLOAT,
+}
+
+
+#╔════════════════════════════════════════════════════════════════════╗
+#║                              FROST                                 ║
+#╚════════════════════════════════════════════════════════════════════╝
+
+#Element columns (e.g. air_temperature) are not declared, as they depend on the request
+FROST_SCHEMA = {
+    'sourceId': STRING,
+    'referenceTime': TIMESTAMP,
+    'elementId': STRING,
+    'value': FLOAT,
+    'timeOffset': STRING,
+    'timeResolution': STRING,
+}
+
+
+#╔════════════════════════════════════════════════════════════════════╗
+#║                              GTFS                                  ║
+#╚════════════════════════════════════════════════════════════════════╝
+
+#Times are kept as HH:MM:SS strings, since GTFS hours may exceed 24
+GTFS_TRIPS_SCHEMA = {
+    'route_id': STRING,
+    'service_id': STRING,
+    'trip_id': STRING,
+    'trip_headsign': STRING,
+    'direction_id': {'dtype': 'Int8'},
+    'shape_id': STRING,
+}
+
+GTFS_STOP_TIMES_SCHEMA = {
+    'trip_id': STRING,
+    'arrival_time': STRING,
+    'departure_time': STRING,
+    'stop_id': STRING,
+    'stop_sequence': {'dtype': 'int32'},
+    'stop_headsign': STRING,
+    'pickup_type': {'dtype': 'Int8'},
+    'drop_off_type': {'dtype': 'Int8'},
+    'shape_dist_traveled': FLOAT,
+}
+
+GTFS_STOPS_SCHEMA = {
+    'stop_id': STRING,
+    'stop_name': STRING,
+    'stop_lat': FLOAT,
+    'stop_lon': FLOAT,
+    'location_type': {'dtype': 'Int8'},
+    'parent_station': STRING,
+}
+
+
+def csv_dtypes(schema, columns = None):
+    """
+    Dtypes to pass to pd.read_csv. Temporal columns are read as strings and parsed afterwards.
+
+    Args:
+        schema (dict): One of the schemas in this module
+        columns (list): Only include these columns. Default is all declared columns
+    """
+
+    temporal = ('datetime', 'date', 'timedelta')
+
+    return {
+        col: 'str' if spec['dtype'] in temporal else spec['dtype']
+        for col, spec in schema.items()
+        if columns is None or col in columns
+    }
@@ -0,0 +1,135 @@
+from scipy.spatial import cKDTree
+import pandas as pd
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+class StationIndex:
+    """
+    Nearest-neighbour index of weather stations.
+
+    Coordinates are converted to points on the unit sphere, so the straight-line (chord) distances
+    of the KD-tree order neighbours the same way as great-circle distances, without any distortion
+    from the latitude.
+    """
+
+    def __init__(self, stations):
+        """
+        Args:
+            stations (dataframe): Columns sourceId, latitude and longitude of each station
+        """
+        self.stations = stations.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+        self.tree = cKDTree(self.to_unit_sphere(self.stations['latitude'], self.stations['longitude']))
+
+    @classmethod
+    def from_frost(cls, response):
+        """
+        Builds the index from a response of FrostAPI.get_weather_stations
+
+        Args:
+            response (dict): Response with the stations in response['data']
+
+        Returns:
+            StationIndex
+        """
+
+        stations = pd.DataFrame([
+            {
+                'sourceId': source['id'],
+                'name': source.get('name'),
+                'latitude': source['geometry']['coordinates'][1],
+                'longitude': source['geometry']['coordinates'][0],
+            }
+            for source in response['data']
+            if source.get('geometry')
+        ], columns=['sourceId', 'name', 'latitude', 'longitude'])
+
+        return cls(stations)
+
+    def __len__(self):
+        return len(self.stations)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             LOOKUPS                                ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def query(self, latitudes, longitudes, k = 1, max_distance_km = None):
+        """
+        Finds the nearest stations of many points at once
+
+        Args:
+            latitudes (array): Latitudes of the points
+            longitudes (array): Longitudes of the points
+            k (int): Number of stations per point
+            max_distance_km (float): Ignore stations further away (optional)
+
+        Returns:
+            tuple: Station positions and distances in km, both of shape (points, k), with k at most the number of stations.
+                   Missing neighbours have position -1 and distance inf
+        """
+
+        k = min(k, len(self.stations))
+        n_points = len(np.atleast_1d(latitudes))
+
+        #Without any stations, e.g. after filtering by elements, no point has neighbours
+        if k == 0:
+            return np.full((n_points, 0), -1, dtype=np.intp), np.full((n_points, 0), np.inf)
+
+        upper_bound = self._chord(max_distance_km) if max_distance_km is not None else np.inf
+
+        chords, positions = self.tree.query(self.to_unit_sphere(latitudes, longitudes), k=k, distance_upper_bound=upper_bound)
+        chords, positions = np.asarray(chords).reshape(-1, k), np.asarray(positions).reshape(-1, k)
+
+        missing = positions >= len(self.stations)
+        positions = np.where(missing, -1, positions)
+        distances = np.where(missing, np.inf, 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords, 2) / 2))
+
+        return positions, distances
+
+    def assign(self, stops, k = 1, max_distance_km = None, id_col = 'stopPointRef'):
+        """
+        Assigns each stop its nearest stations
+
+        Args:
+            stops (dataframe): Columns id_col, latitude and longitude of each stop
+            k (int): Number of stations per stop
+            max_distance_km (float): Ignore stations further away (optional)
+            id_col (str): Column with the stop IDs
+
+        Returns:
+            dataframe: id_col, sourceId, distanceKm and rank (1 is the nearest) of each stop and station.
+                       Empty if the index has no stations
+        """
+
+        stops = stops.dropna(subset=['latitude', 'longitude'])
+        positions, distances = self.query(stops['latitude'].to_numpy(), stops['longitude'].to_numpy(), k, max_distance_km)
+
+        k = positions.shape[1]
+        assignments = pd.DataFrame({
+            id_col: np.repeat(stops[id_col].to_numpy(), k),
+            'position': positions.ravel(),
+            'distanceKm': distances.ravel(),
+            'rank': np.tile(np.arange(1, k + 1), len(stops)),
+        })
+        assignments = assignments[assignments['position'] >= 0]
+
+        assignments.insert(1, 'sourceId', self.stations['sourceId'].to_numpy()[assignments['position']])
+
+        return assignments.drop(columns='position').reset_index(drop=True)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             HELPER                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    @staticmethod
+    def to_unit_sphere(latitudes, longitudes):
+        """Converts coordinates in degrees to (x, y, z) points on the unit sphere"""
+
+        lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+        lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+        return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+    @staticmethod
+    def _chord(distance_km):
+        return 2 * np.sin(min(distance_km / EARTH_RADIUS_KM, np.pi) / 2)
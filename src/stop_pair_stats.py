@@ -0,0 +1,271 @@
+import pandas as pd
+import numpy as np
+
+class StopPairStats:
+    """
+    Mergeable statistics per pair of consecutive stops.
+
+    Each metric is kept as partial moments (count, mean and M2, the sum of squared deviations from the mean),
+    which can be combined with Chan's parallel formula without rescanning the rows they were computed from:
+
+        n    = sum(n_i)
+        mean = sum(n_i * mean_i) / n
+        M2   = sum(M2_i) + sum(n_i * (mean_i - mean)^2)
+
+    Partials computed per day, per partition or per worker can therefore be combined in O(stop pairs).
+    """
+
+    PAIR_KEYS = ['stopPointName', 'nextStopPointName']
+
+    #Output name and source column of each metric
+    METRICS = {
+        'travelTime': 'timeToNextStopMinutes',
+        'scheduledTime': 'aimedTimeToNextStopMinutes',
+        'delay': 'delayMinutes',
+        'delayChange': 'delayChange',
+    }
+    MAX_METRICS = {
+        'delayChange': 'delayChange',
+    }
+
+    def __init__(self, moments, keys = None):
+        """
+        Args:
+            moments (dataframe): Partial moments with one row per key combination
+            keys (list): Key columns of the moments. Default is the stop pair
+        """
+        self.moments = moments
+        self.keys = keys or self.PAIR_KEYS
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                          CONSTRUCTION                              ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    @classmethod
+    def from_frame(cls, df, keys = None):
+        """
+        Computes the partial moments of a processed dataframe
+
+        Args:
+            df (dataframe): Processed data with the metric columns
+            keys (list): Columns to group by. Default is the stop pair
+
+        Returns:
+            StopPairStats
+        """
+
+        keys = keys or cls.PAIR_KEYS
+        grouped = df.groupby(keys, observed=True)
+
+        columns = {}
+        for name, col in cls.METRICS.items():
+            agg = grouped[col].agg(['count', 'mean', 'var'])
+            columns[f'{name}N'] = agg['count']
+            columns[f'{name}Mean'] = agg['mean']
+            columns[f'{name}M2'] = (agg['var'] * (agg['count'] - 1)).fillna(0)
+
+        for name, col in cls.MAX_METRICS.items():
+            columns[f'{name}Max'] = grouped[col].max()
+
+        return cls(pd.DataFrame(columns).reset_index(), keys)
+
+    @classmethod
+    def combine(cls, stats, keys = None):
+        """
+        Combines partial moments, for example from several days or parallel workers
+
+        Args:
+            stats (list): StopPairStats objects or moment dataframes
+            keys (list): Key columns of the result. Default is the keys of the first element
+
+        Returns:
+            StopPairStats
+        """
+
+        frames = [s.moments if isinstance(s, cls) else s for s in stats]
+        if keys is None:
+            keys = stats[0].keys if isinstance(stats[0], cls) else cls.PAIR_KEYS
+
+        return cls(pd.concat(frames, ignore_index=True), keys).collapse(keys)
+
+    def merge(self, other):
+        """Combines these moments with another StopPairStats"""
+
+        return self.combine([self, other], self.keys)
+
+    def collapse(self, keys):
+        """
+        Combines all moments that share the same value of the given keys
+
+        Args:
+            keys (list): Subset of the current keys to keep
+
+        Returns:
+            StopPairStats
+        """
+
+        group_ids = self.moments.groupby(keys, observed=True).ngroup().to_numpy()
+
+        #Rows with a missing key have no group
+        moments = self.moments[group_ids >= 0]
+        group_ids = group_ids[group_ids >= 0]
+
+        unique_ids, first_rows = np.unique(group_ids, return_index=True)
+        n_groups = len(unique_ids)
+
+        result = moments[keys].iloc[first_rows].reset_index(drop=True)
+
+        for name in self.METRICS:
+            n = moments[f'{name}N'].to_numpy(dtype=float)
+            mean = np.nan_to_num(moments[f'{name}Mean'].to_numpy(dtype=float))
+            m2 = moments[f'{name}M2'].to_numpy(dtype=float)
+
+            total_n = np.bincount(group_ids, weights=n, minlength=n_groups)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total_mean = np.bincount(group_ids, weights=n * mean, minlength=n_groups) / total_n
+
+            deviation = np.where(n > 0, n * (mean - np.nan_to_num(total_mean[group_ids])) ** 2, 0)
+            total_m2 = np.bincount(group_ids, weights=m2 + deviation, minlength=n_groups)
+
+            result[f'{name}N'] = total_n.astype(np.int64)
+            result[f'{name}Mean'] = total_mean
+            result[f'{name}M2'] = total_m2
+
+        for name in self.MAX_METRICS:
+            result[f'{name}Max'] = moments[f'{name}Max'].groupby(group_ids).max().reindex(range(n_groups)).to_numpy()
+
+        return StopPairStats(result, keys)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             OUTPUT                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def to_frame(self):
+        """
+        Returns:
+            dataframe: Same layout as DataHandler.get_stop_pair_stats
+        """
+
+        result = self.moments[self.keys].copy()
+
+        for name in self.METRICS:
+            n = self.moments[f'{name}N']
+            result[f'{name}Avg'] = self.moments[f'{name}Mean'].where(n > 0)
+            result[f'{name}Std'] = np.sqrt(self.moments[f'{name}M2'] / (n - 1)).where(n > 1)
+
+        for name in self.MAX_METRICS:
+            result[f'{name}Max'] = self.moments[f'{name}Max']
+
+        result['count'] = self.moments['travelTimeN']
+
+        return result[
+            self.keys + [
+                'travelTimeAvg', 'travelTimeStd', 'scheduledTimeAvg', 'scheduledTimeStd',
+                'delayAvg', 'delayStd', 'delayChangeAvg', 'delayChangeMax', 'count',
+            ]
+        ]
+
+
+class DelayCube:
+    """
+    Stop pair statistics per time of day bucket, weekday and month.
+
+    The cube is computed once from the processed data. A time window query only combines the moments
+    of the buckets inside the window, so it never touches the underlying rows.
+    """
+
+    CUBE_KEYS = ['timeBucket', 'weekday', 'month']
+
+    def __init__(self, stats, bucket_minutes = 15):
+        """
+        Args:
+            stats (StopPairStats): Moments keyed by stop pair, time bucket, weekday and month
+            bucket_minutes (int): Width of the time of day buckets
+        """
+        self.stats = stats
+        self.bucket_minutes = bucket_minutes
+
+    @classmethod
+    def from_frame(cls, df, bucket_minutes = 15, time_col = 'aimedStopTime'):
+        """
+        Builds the cube from processed data
+
+        Args:
+            df (dataframe): Processed data
+            bucket_minutes (int): Width of the time of day buckets
+            time_col (str): Time column that decides the bucket, weekday and month of each row
+
+        Returns:
+            DelayCube
+        """
+
+        times = df[time_col]
+
+        if f'{time_col}OfDay' in df.columns:
+            #Missing times are stored as -1
+            seconds = df[f'{time_col}OfDay'].where(df[f'{time_col}OfDay'] >= 0)
+        else:
+            seconds = times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second
+
+        keyed = df.assign(
+            timeBucket=seconds // (bucket_minutes * 60),
+            weekday=times.dt.weekday,
+            month=times.dt.month,
+        )
+
+        return cls(StopPairStats.from_frame(keyed, StopPairStats.PAIR_KEYS + cls.CUBE_KEYS), bucket_minutes)
+
+    def query(self, start_time, end_time, weekdays = None, months = None):
+        """
+        Stop pair statistics for a time of day window.
+        The window is widened to whole buckets, and wraps past midnight when start_time is later than end_time.
+
+        Args:
+            start_time: Start of the window, as HH:MM:SS or a datetime
+            end_time: End of the window, as HH:MM:SS or a datetime
+            weekdays (list): Weekdays to include, 0 is Monday. Default is all
+            months (list): Months to include, 1 is January. Default is all
+
+        Returns:
+            StopPairStats: Moments per stop pair within the window
+        """
+
+        bucket_seconds = self.bucket_minutes * 60
+        start_seconds, end_seconds = self._seconds_of_day(start_time), self._seconds_of_day(end_time)
+
+        start_bucket = start_seconds // bucket_seconds
+        end_bucket = -(-end_seconds // bucket_seconds) - 1
+
+        moments = self.stats.moments
+        buckets = moments['timeBucket']
+
+        #Only a window whose times cross midnight wraps, a window ending on the boundary of its start bucket covers that bucket
+        if start_seconds <= end_seconds:
+            mask = (buckets >= start_bucket) & (buckets <= max(end_bucket, start_bucket))
+        else:
+            mask = (buckets >= start_bucket) | (buckets <= end_bucket)
+
+        if weekdays is not None:
+            mask &= moments['weekday'].isin(weekdays)
+        if months is not None:
+            mask &= moments['month'].isin(months)
+
+        return StopPairStats(moments[mask], self.stats.keys).collapse(StopPairStats.PAIR_KEYS)
+
+    def save(self, filepath):
+        self.stats.moments.assign(bucketMinutes=self.bucket_minutes).to_parquet(filepath, index=False)
+
+        return filepath
+
+    @classmethod
+    def load(cls, filepath):
+        moments = pd.read_parquet(filepath)
+        bucket_minutes = int(moments.pop('bucketMinutes').iloc[0]) if len(moments) else 15
+
+        return cls(StopPairStats(moments, StopPairStats.PAIR_KEYS + cls.CUBE_KEYS), bucket_minutes)
+
+    @staticmethod
+    def _seconds_of_day(value):
+        value = pd.Timestamp(value) if not isinstance(value, str) else pd.Timestamp('1900-01-01 ' + value)
+
+        return value.hour * 3600 + value.minute * 60 + value.second
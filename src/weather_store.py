@@ -0,0 +1,231 @@
+from schemas import FROST_SCHEMA
+from slugify import slugify
+from datetime import timedelta
+import pandas as pd
+import threading
+import json
+import os
+
+class WeatherStore:
+    """
+    Local store of Frost observations per weather station and element.
+
+    The observations of each station and element are kept in one parquet file in the long layout
+    of DataFetcher.frost_data_to_df. A coverage index records the date ranges that have been
+    downloaded, including ranges without any observations, so only the missing ranges of a request
+    need to be fetched.
+
+    Stations are identified without the sensor suffix of the sourceId (e.g. 'SN18700', not 'SN18700:0').
+    """
+
+    COLUMNS = list(FROST_SCHEMA)
+
+    def __init__(self, store_dir):
+        """
+        Args:
+            store_dir (str): Directory of the observation files and the coverage index
+        """
+        self.store_dir = store_dir
+        self.coverage_path = os.path.join(store_dir, 'coverage.json')
+        self._lock = threading.Lock()
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                            COVERAGE                                ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def load_coverage(self):
+        """
+        Returns:
+            dict: {station: {element: [[start_date, end_date], ...]}} with inclusive dates in YYYY-MM-DD format
+        """
+
+        if not os.path.exists(self.coverage_path):
+            return {}
+
+        with open(self.coverage_path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def get_missing_ranges(self, station, element, start_date, end_date):
+        """
+        Get the parts of a date range that are not in the store
+
+        Args:
+            station (str): Weather station ID
+            element (str): Weather element
+            start_date (str): Format: YYYY-MM-DD
+            end_date (str): Format: YYYY-MM-DD
+
+        Returns:
+            list: Missing (start_date, end_date) ranges
+        """
+
+        covered = self.load_coverage().get(station, {}).get(element, [])
+
+        missing = []
+        current = pd.Timestamp(start_date)
+        end = pd.Timestamp(end_date)
+
+        for covered_start, covered_end in covered:
+            covered_start, covered_end = pd.Timestamp(covered_start), pd.Timestamp(covered_end)
+
+            if covered_end < current:
+                continue
+            if covered_start > end:
+                break
+
+            if covered_start > current:
+                missing.append((current, covered_start - timedelta(days=1)))
+            current = covered_end + timedelta(days=1)
+
+        if current <= end:
+            missing.append((current, end))
+
+        return [(start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')) for start, end in missing]
+
+    def is_covered(self, stations, elements, start_date, end_date):
+        """Checks that every station and element is stored for the whole date range"""
+
+        return not any(
+            self.get_missing_ranges(station, element, start_date, end_date)
+            for station in stations for element in elements
+        )
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                          READ / WRITE                              ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    def add(self, df, stations, elements, start_date, end_date):
+        """
+        Stores downloaded observations and marks the date range as covered for the requested stations and elements.
+        Only complete days (UTC) are marked as covered, so today and later dates are downloaded again by later requests.
+
+        Args:
+            df (dataframe): Observations in the long layout of DataFetcher.frost_data_to_df
+            stations (list): Stations that were requested
+            elements (list): Elements that were requested
+            start_date (str): First date of the downloaded range, format: YYYY-MM-DD
+            end_date (str): Last date of the downloaded range, format: YYYY-MM-DD
+        """
+
+        df = df if df is not None else pd.DataFrame(columns=self.COLUMNS)
+        df_stations = df['sourceId'].astype(str).str.split(':').str[0]
+
+        with self._lock:
+            for station in stations:
+                for element in elements:
+                    rows = df[(df_stations == station) & (df['elementId'] == element)]
+                    if not rows.empty:
+                        self._write(station, element, rows)
+
+            end_date = min(end_date, self.last_complete_date())
+            if end_date < start_date:
+                return
+
+            coverage = self.load_coverage()
+            for station in stations:
+                for element in elements:
+                    ranges = coverage.setdefault(station, {}).setdefault(element, [])
+                    coverage[station][element] = self._merge_ranges(ranges + [[start_date, end_date]])
+
+            self._save_coverage(coverage)
+
+    def load(self, stations, elements, start_date, end_date, pivot = False):
+        """
+        Load stored observations
+
+        Args:
+            stations (list): Weather station IDs
+            elements (list): Weather elements
+            start_date (str): Format: YYYY-MM-DD
+            end_date (str): Format: YYYY-MM-DD, inclusive
+            pivot (bool): Return one row per station and reference time with a column for each element
+
+        Returns:
+            dataframe: Observations in the range, sorted by time
+        """
+
+        start = pd.Timestamp(start_date, tz='UTC')
+        end = pd.Timestamp(end_date, tz='UTC') + timedelta(days=1)
+
+        dfs = []
+        for station in stations:
+            for element in elements:
+                path = self._path(station, element)
+                if not os.path.exists(path):
+                    continue
+
+                df = pd.read_parquet(path, filters=[('referenceTime', '>=', start), ('referenceTime', '<', end)])
+                dfs.append(df)
+
+        df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=self.COLUMNS)
+        df = df.sort_values(['referenceTime', 'sourceId'], ignore_index=True)
+
+        if not pivot:
+            return df
+
+        return self.pivot(df)
+
+    #╔════════════════════════════════════════════════════════════════════╗
+    #║                             HELPER                                 ║
+    #╚════════════════════════════════════════════════════════════════════╝
+
+    @staticmethod
+    def pivot(df):
+        """
+        Pivots observations to one row per station and reference time with a column for each element.
+        If an element has several observations at the same time (e.g. different time offsets), the first is kept.
+        """
+
+        wide = (
+            df.drop_duplicates(['sourceId', 'referenceTime', 'elementId'])
+            .pivot(index=['sourceId', 'referenceTime'], columns='elementId', values='value')
+            .reset_index()
+        )
+        wide.columns.name = None
+
+        return wide
+
+    @staticmethod
+    def last_complete_date():
+        """Yesterday (UTC) in YYYY-MM-DD format, the last day whose observations can be complete"""
+        return (pd.Timestamp.now(tz='UTC').normalize() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    def _path(self, station, element):
+        return os.path.join(self.store_dir, slugify(station), slugify(element) + '.parquet')
+
+    def _write(self, station, element, rows):
+        path = self._path(station, element)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if os.path.exists(path):
+            rows = pd.concat([pd.read_parquet(path), rows], ignore_index=True)
+
+        rows = (
+            rows[self.COLUMNS]
+            .drop_duplicates(['sourceId', 'referenceTime', 'elementId', 'timeOffset'], keep='last')
+            .sort_values('referenceTime', ignore_index=True)
+        )
+
+        rows.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+
+    def _save_coverage(self, coverage):
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        with open(self.coverage_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(coverage, file, indent=2)
+
+        os.replace(self.coverage_path + '.tmp', self.coverage_path)
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        """Merges overlapping and adjacent inclusive date ranges"""
+
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and pd.Timestamp(start) <= pd.Timestamp(merged[-1][1]) + timedelta(days=1):
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        return merged
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+#The modules in src import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', help='Run the benchmarks, which are skipped by default')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: wall-clock benchmark, only run with --benchmark')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason='benchmark, run with --benchmark')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,156 @@
+import os
+
+import pandas as pd
+
+import main
+from data_handler import DataHandler
+
+
+def make_handler(tmp_path):
+    handler = DataHandler()
+    handler.raw_dir = str(tmp_path / 'raw')
+    handler.processed_dir = str(tmp_path / 'processed')
+    handler.stop_pair_stats_dir = str(tmp_path / 'processed' / 'Stop-pair-stats')
+    handler.manifest_path = str(tmp_path / 'processed' / 'Entur-data' / 'manifest.json')
+    return handler
+
+
+def raw_journeys(dates, target_time):
+    """Three stops of one journey per date, in the layout returned by EnturSQL.get_data_by_lineid_and_timewindows"""
+
+    rows = []
+    for date in dates:
+        for sequence_nr in range(1, 4):
+            aimed = pd.Timestamp(f'{date} {target_time}', tz='UTC') + pd.Timedelta(minutes=2 * sequence_nr)
+            rows.append({
+                'lineRef': 'RUT:Line:34', 'directionRef': 'Outbound', 'operatingDate': date,
+                'serviceJourneyId': 'RUT:ServiceJourney:1', 'sequenceNr': sequence_nr,
+                'stopPointRef': f'NSR:Quay:{sequence_nr}', 'stopPointName': f'Stop {sequence_nr}',
+                'originName': 'Stop 1', 'destinationName': 'Stop 3',
+                'aimedArrivalTime': aimed, 'arrivalTime': aimed + pd.Timedelta(seconds=30),
+                'aimedDepartureTime': aimed, 'departureTime': aimed + pd.Timedelta(seconds=45),
+                'targetTime': target_time,
+            })
+
+    return pd.DataFrame(rows)
+
+
+class StubFetcher:
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def get_data_SQL(self, *args, **kwargs):
+        return self.results.pop(0)
+
+
+def test_dates_processed_with_other_target_times_are_pending(tmp_path):
+    handler = make_handler(tmp_path)
+
+    morning = handler.selection_key(['08:00:00'], 5)
+    handler.update_manifest('RUT:Line:34', ['2024-01-01', '2024-01-02'], selection=morning)
+
+    assert handler.get_pending_dates('RUT:Line:34', '2024-01-01', '2024-01-02', selection=morning) == []
+    assert handler.get_pending_dates('RUT:Line:34', '2024-01-01', '2024-01-02', selection=handler.selection_key(['08:00:00', '16:00:00'], 5)) == ['2024-01-01', '2024-01-02']
+    assert handler.get_pending_dates('RUT:Line:34', '2024-01-01', '2024-01-02', selection=handler.selection_key(['08:00:00'], 10)) == ['2024-01-01', '2024-01-02']
+
+
+def test_rerun_without_data_clears_rows_of_earlier_selection(tmp_path, monkeypatch):
+    handler = make_handler(tmp_path)
+    dates = ['2024-01-01', '2024-01-02']
+
+    empty = raw_journeys([], '03:00:00').reindex(columns=raw_journeys(dates, '08:00:00').columns)
+    monkeypatch.setattr(main, 'handler', handler, raising=False)
+    monkeypatch.setattr(main, 'fetcher', StubFetcher(raw_journeys(dates, '08:00:00'), empty), raising=False)
+
+    main.process_date_range('RUT:Line:34', dates[0], dates[-1], dates, ['08:00:00'])
+    assert len(handler.load_processed_entur_data(handler.entur_dataset)) == 6
+
+    main.process_date_range('RUT:Line:34', dates[0], dates[-1], dates, ['03:00:00'])
+
+    assert handler.load_raw_entur_data(handler.entur_dataset).empty
+    assert handler.load_processed_entur_data(handler.entur_dataset).empty
+    assert not any(files for _, _, files in os.walk(handler.stop_pair_stats_dir))
+
+    manifest = handler.load_manifest()['RUT:Line:34']
+    assert [(manifest[date]['rows'], manifest[date]['selection']) for date in dates] == [(0, '03:00:00/5')] * 2
+
+
+def test_compact_dtypes_keeps_codes_of_a_shared_stop_dictionary(tmp_path):
+    handler = make_handler(tmp_path)
+    dictionary = ['A', 'C']
+
+    #Each chunk extends the dictionary of the previous one, without moving the stops already in it
+    for chunk in [['A', 'C'], ['B', 'A'], ['C', 'B', 'D']]:
+        compacted = handler.compact_dtypes(pd.DataFrame({'stopPointName': chunk, 'nextStopPointName': chunk[1:] + [None]}), stop_categories=dictionary)
+        categories = list(compacted['stopPointName'].cat.categories)
+
+        assert categories[:len(dictionary)] == dictionary
+        assert compacted['stopPointName'].tolist() == chunk
+        dictionary = categories
+
+    assert dictionary == ['A', 'C', 'B', 'D']
+
+
+def processed_journeys(dates, journeys = ('RUT:ServiceJourney:1', 'RUT:ServiceJourney:2')):
+    """Merged stop times of a few journeys per date, with varying delays and a skipped sequence number"""
+
+    rows = []
+    for d, date in enumerate(dates):
+        for j, journey_id in enumerate(journeys):
+            for i, sequence_nr in enumerate([1, 2, 4, 5]):
+                aimed = pd.Timestamp(f'{date} 08:00', tz='UTC') + pd.Timedelta(minutes=30 * j + 3 * i)
+                rows.append({
+                    'operatingDate': pd.Timestamp(date), 'serviceJourneyId': journey_id, 'sequenceNr': sequence_nr,
+                    'stopPointName': f'Stop {sequence_nr}', 'aimedStopTime': aimed,
+                    'stopTime': aimed + pd.Timedelta(seconds=20 * i + 7 * j + 11 * d),
+                })
+
+    #Rows arrive unordered from the source
+    return pd.DataFrame(rows).sample(frac=1, random_state=1).reset_index(drop=True)
+
+
+FEATURES = [
+    'nextSequenceNr', 'nextStopPointName', 'delay', 'delayMinutes', 'delayChange',
+    'timeToNextStop', 'aimedTimeToNextStop', 'timeToNextStopMinutes', 'aimedTimeToNextStopMinutes',
+]
+
+
+def test_journey_features_match_per_feature_methods_within_a_day(tmp_path):
+    handler = make_handler(tmp_path)
+    df = processed_journeys(['2024-01-01'])
+
+    expected = df.sort_values(['operatingDate', 'serviceJourneyId', 'sequenceNr'])
+    expected = handler.append_next_stop(expected)
+    expected = handler.calculate_delay(expected)
+    expected = handler.calculate_delay_change(expected)
+    expected = handler.calculate_time_between_stops(expected)
+
+    result = handler.engineer_journey_features(df.copy())
+
+    pd.testing.assert_frame_equal(
+        result[FEATURES].reset_index(drop=True).astype(object).where(result[FEATURES].notna().to_numpy(), None),
+        expected[FEATURES].reset_index(drop=True).astype(object).where(expected[FEATURES].notna().to_numpy(), None),
+    )
+
+
+def test_journey_features_are_masked_at_day_and_journey_boundaries(tmp_path):
+    handler = make_handler(tmp_path)
+
+    #The same journey ID runs on two consecutive days
+    result = handler.engineer_journey_features(processed_journeys(['2024-01-01', '2024-01-02']))
+
+    last_stops = result['sequenceNr'] == 5
+    first_stops = result['sequenceNr'] == 1
+
+    for col in ['nextSequenceNr', 'timeToNextStop', 'aimedTimeToNextStop', 'timeToNextStopMinutes']:
+        assert result.loc[last_stops, col].isna().all(), col
+        assert result.loc[~last_stops, col].notna().all(), col
+    assert result.loc[first_stops, 'delayChange'].isna().all()
+    assert result.loc[~first_stops, 'delayChange'].notna().all()
+
+    #No travel time spans from one day or journey into the next
+    assert result['timeToNextStopMinutes'].max() < 10
+
+    #The next stop name is only set for consecutive sequence numbers
+    assert result.loc[result['sequenceNr'] == 2, 'nextStopPointName'].isna().all()
+    assert (result.loc[result['sequenceNr'] == 4, 'nextStopPointName'] == 'Stop 5').all()
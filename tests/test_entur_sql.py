@@ -0,0 +1,93 @@
+import pyarrow as pa
+import pandas as pd
+import pytest
+
+from entur_data import EnturSQL
+
+
+class StubClient:
+    """Stands in for bigquery.Client, returning a fixed table in pages for every query"""
+
+    project = 'stub'
+
+    def __init__(self, table):
+        self.table = table
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        return self
+
+    def result(self, page_size=None):
+        self.page_size = page_size
+        return self
+
+    def to_arrow_iterable(self):
+        return iter(self.table.to_batches(max_chunksize=self.page_size))
+
+
+@pytest.fixture
+def table():
+    #Operating dates of different sizes, so pages end in the middle of a date
+    dates = ['2024-01-01'] * 7 + ['2024-01-02'] * 3 + ['2024-01-03'] * 11
+    return pa.table({
+        'operatingDate': pa.array(pd.to_datetime(dates).date, type=pa.date32()),
+        'serviceJourneyId': [f'J{i // 2}' for i in range(len(dates))],
+        'sequenceNr': list(range(len(dates))),
+    })
+
+
+@pytest.fixture
+def sql(tmp_path, table):
+    return EnturSQL(cache_dir=str(tmp_path / 'cache'), client=StubClient(table))
+
+
+def windows_query(sql):
+    return sql.get_data_by_lineid_and_timewindows('RUT:Line:34', '2024-01-01', '2024-01-03', {'08:00:00': ('07:55:00', '08:05:00')}, execute=False)
+
+
+def test_stream_parts_keep_operating_dates_whole(sql, table):
+    parts = list(sql.iter_query_dataframes(windows_query(sql), max_rows=4, align_on=('operatingDate',), page_size=2))
+
+    assert sum(len(part) for part in parts) == table.num_rows
+    assert len(parts) == 3
+
+    dates = [set(part['operatingDate']) for part in parts]
+    for i, part_dates in enumerate(dates):
+        assert not any(part_dates & other for other in dates[i + 1:])
+
+
+def test_stream_miss_is_cached_for_next_stream(sql, table):
+    query = windows_query(sql)
+
+    first = pd.concat(sql.iter_query_dataframes(query, max_rows=4, align_on=('operatingDate',), page_size=2), ignore_index=True)
+    second = pd.concat(sql.iter_query_dataframes(query, max_rows=4, align_on=('operatingDate',), page_size=2), ignore_index=True)
+
+    stats = sql.get_cache_stats()
+    assert (stats['misses'], stats['hits'], stats['results']) == (1, 1, 1)
+    assert len(sql.client.queries) == 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_window_query_is_built_without_client():
+    sql = EnturSQL(cache_dir=None)
+    windows = {'23:58:00': ('23:53:00', '00:03:00'), '08:00:00': ('07:55:00', '08:05:00')}
+
+    query = sql.get_data_by_lineid_and_timewindows('RUT:Line:34', '2024-01-01', '2024-01-07', windows, days_of_week=[2, 3], execute=False)
+    normalized = ' '.join(query.split())
+
+    assert sql._client is None
+
+    #One scan of the table, with the explicit columns and the window of each journey from its first stop
+    assert normalized.count('FROM ' + sql.table_id) == 1
+    assert 'SELECT ' + ', '.join(sql.columns) + ', MAX(IF(sequenceNr = 1, CASE' in normalized
+    assert 'OVER (PARTITION BY operatingDate, serviceJourneyId) AS targetTime' in normalized
+    assert 'WHERE targetTime IS NOT NULL ORDER BY operatingDate, serviceJourneyId, sequenceNr' in normalized
+    assert 'operatingDate BETWEEN "2024-01-01" AND "2024-01-07" AND lineRef = "RUT:Line:34" AND dayOfTheWeek IN (2, 3)' in normalized
+
+    #Windows are ordered by start time, and a window past midnight wraps around
+    first = normalized.index('WHEN TIME(aimedDepartureTime) BETWEEN "07:55:00" AND "08:05:00" THEN "08:00:00"')
+    second = normalized.index('WHEN (TIME(aimedDepartureTime) >= "23:53:00" OR TIME(aimedDepartureTime) <= "00:03:00") THEN "23:58:00"')
+    assert first < second
+
+    assert not set(sql.exceptions) & set(sql.columns)
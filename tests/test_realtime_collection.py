@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+import time
+
+import pandas as pd
+import pytest
+
+from realtime_collection import JourneyBatch, JourneyTracker
+
+
+def make_journeys(n_journeys, n_calls):
+    """Journeys in the layout of the realtime query, where the later calls have not departed yet"""
+
+    start = datetime(2024, 3, 30, 23, 0, tzinfo=timezone(timedelta(hours=1)))
+
+    def at(minutes):
+        return (start + timedelta(minutes=minutes)).isoformat()
+
+    journeys = []
+    for j in range(n_journeys):
+        calls = []
+        for c in range(n_calls):
+            departed = c < n_calls // 2
+            call = {field: at(j + c) for field in JourneyBatch.TIME_FIELDS}
+            call['actualArrivalTime'] = call['actualDepartureTime'] = at(j + c + 1) if departed else None
+            call.update({'realtime': True, 'stopPositionInPattern': c, 'quay': {'id': f'NSR:Quay:{c}', 'name': f'Stop {c}'}})
+            calls.append(call)
+        journeys.append({'id': f'RUT:ServiceJourney:{j}', 'estimatedCalls': calls})
+
+    return journeys
+
+
+def poll(*journeys):
+    """Response of get_realtime_journeys with journeys given as {stopPositionInPattern: departed}"""
+
+    def call(position, departed):
+        return {'stopPositionInPattern': position, 'actualDepartureTime': '2024-01-01T08:00:00+01:00' if departed else None}
+
+    return {'line': {'serviceJourneys': [
+        {'id': journey_id, 'estimatedCalls': [call(position, departed) for position, departed in calls.items()]}
+        for journey_id, calls in journeys
+    ]}}
+
+
+def emitted(new_calls):
+    return [(journey['id'], sequence_nr) for journey, _, sequence_nr in new_calls]
+
+
+def test_tracker_emits_each_call_once_and_finalizes_journeys():
+    tracker = JourneyTracker(evict_after=2)
+
+    #Position 1 has no real-time data yet, so it is missing from the filtered calls
+    assert emitted(tracker.update(poll(('A', {0: True, 2: False}), ('B', {0: False})))) == [('A', 1)]
+    assert tracker.emitted == {'A': {0}}
+
+    #Position 1 gets real-time data late, and A ends
+    assert emitted(tracker.update(poll(('A', {0: True, 1: True, 2: True}), ('B', {0: True, 1: False})))) == [('A', 2), ('A', 3), ('B', 1)]
+    assert tracker.finished == {'A'}
+    assert tracker.emitted == {'B': {0}}
+    assert tracker.active_journeys() == 1
+
+    #Finished journeys stay in the responses, but are skipped and keep no positions
+    assert emitted(tracker.update(poll(('A', {0: True, 1: True, 2: True}), ('B', {0: True, 1: True})))) == [('B', 2)]
+    assert tracker.finished == {'A', 'B'}
+    assert tracker.emitted == {}
+
+    #Journeys missing from the responses are forgotten
+    tracker.update(poll(('B', {0: True, 1: True})))
+    tracker.update(poll(('B', {0: True, 1: True})))
+    assert tracker.finished == {'B'}
+    assert 'A' not in tracker.last_seen
+
+
+def row_frame(journeys, transport_mode):
+    """Reference conversion with one dict per call and one timestamp parse per column"""
+
+    rows = []
+    for journey in journeys:
+        for call in journey['estimatedCalls']:
+            row = {key: value for key, value in call.items() if key not in ('quay', 'realtime', 'stopPositionInPattern')}
+            row['id'] = journey['id']
+            row['stop'] = call['quay']['name']
+            row['sequenceNr'] = call['stopPositionInPattern'] + 1
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if transport_mode == 'bus':
+        df = df.drop(['aimedArrivalTime', 'expectedArrivalTime'], axis=1)
+
+    for col in [col for col in df.columns if 'Time' in col]:
+        df[col] = pd.to_datetime(df[col], format='ISO8601', utc=True)
+
+    return df
+
+
+def batch_frame(journeys, transport_mode):
+    batch = JourneyBatch(transport_mode)
+    for journey in journeys:
+        for call in journey['estimatedCalls']:
+            batch.append(journey['id'], call, call['stopPositionInPattern'] + 1)
+
+    return batch.to_frame()
+
+
+@pytest.mark.parametrize('transport_mode', ['bus', 'rail'])
+def test_batch_matches_row_conversion(transport_mode):
+    journeys = make_journeys(20, 10)
+
+    expected = row_frame(journeys, transport_mode)
+    result = batch_frame(journeys, transport_mode)
+
+    assert list(result.columns) == JourneyBatch(transport_mode).time_fields + ['id', 'stop', 'sequenceNr']
+    assert str(result['sequenceNr'].dtype) == 'int32'
+    pd.testing.assert_frame_equal(result, expected[result.columns], check_dtype=False)
+
+
+@pytest.mark.benchmark
+def test_batch_benchmark():
+    """500 journeys x 30 calls, the size of a poll of a large line. Run with pytest --benchmark -s"""
+
+    journeys = make_journeys(500, 30)
+
+    def best_of(convert, repeats=3):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            convert(journeys, 'bus')
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    rows, batch = best_of(row_frame), best_of(batch_frame)
+    print(f"\n500 x 30 calls: rows {rows:.3f} s, JourneyBatch {batch:.3f} s")
+
+    assert batch < rows
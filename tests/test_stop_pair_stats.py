@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stop_pair_stats import DelayCube
+
+
+@pytest.fixture
+def cube():
+    times = pd.Timestamp('2024-01-01', tz='UTC') + pd.to_timedelta(np.arange(0, 86400, 60), unit='s')
+    df = pd.DataFrame({
+        'stopPointName': 'A', 'nextStopPointName': 'B', 'aimedStopTime': times,
+        'timeToNextStopMinutes': 1.0, 'aimedTimeToNextStopMinutes': 1.0, 'delayMinutes': 1.0, 'delayChange': 0.5,
+    })
+    return DelayCube.from_frame(df, 15, 'aimedStopTime')
+
+
+@pytest.mark.parametrize('start, end, minutes', [
+    ('08:00:00', '08:00:00', 15),
+    ('07:00:00', '08:00:00', 60),
+    ('07:50:00', '08:10:00', 30),
+    ('23:00:00', '01:00:00', 120),
+    ('23:00:00', '00:00:00', 60),
+])
+def test_query_widens_to_whole_buckets_and_only_wraps_across_midnight(cube, start, end, minutes):
+    assert cube.query(start, end).to_frame()['count'].sum() == minutes